@@ -0,0 +1,321 @@
+# benchmark of the hot routes against a synthetic database.
+#
+#   python benchmark.py --scale small
+#   python benchmark.py --scale large --concurrency 16 --compare old.json
+#
+# the database is built by the app's own 'flask seed' generator. every route
+# is driven through the flask test client (latency and sql
+# statements per request) and through concurrent http clients against a
+# threaded server (throughput and latency under load). results are written
+# to benchmark-results/<commit>-<scale>.json for comparison between commits
+import argparse, http.client, json, os, random, statistics, subprocess, sys
+import threading, time, urllib.parse
+from datetime import datetime
+
+from flask import request_finished, request_started
+
+ADMIN = ('navjot', 'password')
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+    description='Benchmark the hot routes against a synthetic database.')
+  parser.add_argument('--scale', default='tiny',
+                      choices=['tiny', 'small', 'medium', 'large'])
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--db', help='database file, seeded when missing')
+  parser.add_argument('--reseed', action='store_true')
+  parser.add_argument('--requests', type=int, default=200,
+                      help='requests per route and mode')
+  parser.add_argument('--concurrency', type=int, default=8)
+  parser.add_argument('--routes', help='comma separated subset of routes')
+  parser.add_argument('--output', help='results file')
+  parser.add_argument('--compare', help='earlier results file to diff against')
+  return parser.parse_args()
+
+
+def percentile(samples, fraction):
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, elapsed, statements=None):
+  result = {
+    'requests': len(latencies),
+    'throughput': round(len(latencies) / elapsed, 1),
+    'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+    'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+    'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    'mean_ms': round(statistics.fmean(latencies) * 1000, 2),
+  }
+  if statements:
+    result['sql_statements'] = round(statistics.fmean(statements), 1)
+  return result
+
+
+# routes under test: name -> (admin?, request builder). a builder returns
+# (method, path, form) for one request, given a random generator and the
+# seeded scale
+def route_table(scale):
+  product_id = in_stock_product(scale)
+
+  def checkout(rng):
+    return 'POST', '/user/checkout', {}
+
+  return {
+    'user_dashboard': (False, lambda rng: ('GET', '/user/dashboard', None)),
+    'search_price': (False, lambda rng: (
+      'GET', f"/user/search?min_price={rng.randint(5, 450)}", None)),
+    'search_text': (False, lambda rng: (
+      'POST', '/user/search', {'search_query': f"product {rng.randint(1, 999)}"})),
+    'add_to_cart': (False, lambda rng: (
+      'POST', '/add_to_cart', {'product_id': product_id(rng), 'quantity': 1})),
+    'checkout': (False, checkout),
+    'purchase_history': (False, lambda rng: ('GET', '/user/history', None)),
+    'admin_insights': (True, lambda rng: ('GET', '/admin/insights', None)),
+  }
+
+
+# every 50th seeded product is sold out, carts and checkouts skip those
+def in_stock_product(scale):
+  def product_id(rng):
+    while True:
+      number = rng.randrange(scale['products'])
+      if number % 50 != 49:
+        return number + 1
+  return product_id
+
+
+# a checkout only buys something when the cart is filled first
+def prepare(name, send, rng, scale):
+  if name == 'checkout':
+    send('POST', '/add_to_cart',
+         {'product_id': in_stock_product(scale)(rng), 'quantity': 1})
+
+
+def run_test_client(main, name, admin, build, count, scale, rng):
+  client = main.app.test_client()
+  if admin:
+    client.post('/admin/login', data=dict(zip(('username', 'password'), ADMIN)))
+  else:
+    client.post('/login', data={
+      'username': f"user{rng.randrange(scale['users'])}",
+      'password': main.SEED_PASSWORD})
+
+  def send(method, path, form):
+    return client.open(path, method=method, data=form)
+
+  statements = []
+  counter = {'count': 0}
+
+  def count_statement(sql):
+    # statements run by triggers are reported as "-- TRIGGER ..." comments
+    if not sql.startswith('--'):
+      counter['count'] += 1
+
+  def start_tracing(sender, **extra):
+    main.get_db().set_trace_callback(count_statement)
+
+  def stop_tracing(sender, **extra):
+    main.get_db().set_trace_callback(None)
+
+  for _ in range(min(10, count)):
+    prepare(name, send, rng, scale)
+    send(*build(rng))
+
+  latencies = []
+  started = time.perf_counter()
+  request_started.connect(start_tracing, main.app)
+  request_finished.connect(stop_tracing, main.app)
+  try:
+    for _ in range(count):
+      prepare(name, send, rng, scale)
+      counter['count'] = 0
+      sent_at = time.perf_counter()
+      response = send(*build(rng))
+      latencies.append(time.perf_counter() - sent_at)
+      statements.append(counter['count'])
+      if response.status_code >= 400:
+        raise SystemExit(f"{name}: HTTP {response.status_code}")
+  finally:
+    request_started.disconnect(start_tracing, main.app)
+    request_finished.disconnect(stop_tracing, main.app)
+  return summarize(latencies, time.perf_counter() - started, statements)
+
+
+class HttpClient:
+
+  def __init__(self, port):
+    self.port = port
+    self.cookie = None
+
+  def send(self, method, path, form=None):
+    connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+    headers = {'Cookie': self.cookie} if self.cookie else {}
+    body = None
+    if form is not None:
+      body = urllib.parse.urlencode(form)
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    cookie = response.getheader('Set-Cookie')
+    if cookie:
+      self.cookie = cookie.split(';', 1)[0]
+    if response.status >= 400:
+      raise RuntimeError(f"{method} {path}: HTTP {response.status}")
+    return response.status
+
+
+def run_http(port, name, admin, build, count, concurrency, scale, seed,
+             password):
+  latencies = []
+  errors = []
+  lock = threading.Lock()
+
+  def client_thread(number, requests):
+    rng = random.Random(f"{seed}-{name}-{number}")
+    client = HttpClient(port)
+    try:
+      if admin:
+        client.send('POST', '/admin/login', dict(zip(('username', 'password'), ADMIN)))
+      else:
+        client.send('POST', '/login', {
+          'username': f"user{rng.randrange(scale['users'])}",
+          'password': password})
+      for _ in range(requests):
+        prepare(name, client.send, rng, scale)
+        sent_at = time.perf_counter()
+        client.send(*build(rng))
+        elapsed = time.perf_counter() - sent_at
+        with lock:
+          latencies.append(elapsed)
+    except Exception as error:
+      with lock:
+        errors.append(str(error))
+
+  threads = [
+    threading.Thread(target=client_thread,
+                     args=(number, count // concurrency +
+                           (number < count % concurrency)))
+    for number in range(concurrency)
+  ]
+  started = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise SystemExit(f"{name}: {errors[0]}")
+  result = summarize(latencies, time.perf_counter() - started)
+  result['concurrency'] = concurrency
+  return result
+
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          capture_output=True, text=True,
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+
+def compare(results, baseline_path):
+  with open(baseline_path) as baseline_file:
+    baseline = json.load(baseline_file)
+  print(f"\ncompared with {baseline['commit']} ({baseline_path}):")
+  for name, modes in results['routes'].items():
+    for mode, result in modes.items():
+      old = baseline['routes'].get(name, {}).get(mode)
+      if not old:
+        continue
+      changes = ', '.join(
+        f"{key} {old[key]} -> {result[key]} ({(result[key] - old[key]) / old[key]:+.0%})"
+        for key in ('p50_ms', 'p95_ms', 'throughput') if old.get(key))
+      print(f"  {name:18} {mode:12} {changes}")
+
+
+def main():
+  args = parse_args()
+  db_path = os.path.abspath(args.db or f"benchmark-{args.scale}-{args.seed}.db")
+  if args.reseed:
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(db_path + suffix):
+        os.remove(db_path + suffix)
+  needs_seed = not os.path.exists(db_path)
+
+  # the app reads its configuration at import
+  os.environ['FLASK_DATABASE'] = db_path
+  os.environ['FLASK_JOB_WORKER'] = 'false'
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  import main as store
+
+  scale = store.SEED_SCALES[args.scale]
+  if needs_seed:
+    print(f"seeding {db_path} ({args.scale}: {scale})")
+    started = time.perf_counter()
+    with store.app.app_context():
+      store.seed_store(store.get_db(), seed=args.seed, images=store.seed_image_pool(
+        os.path.join(store.app.root_path, store.app.config['UPLOAD_FOLDER'])),
+                       **scale)
+    print(f"seeded in {time.perf_counter() - started:.1f}s")
+
+  routes = route_table(scale)
+  if args.routes:
+    routes = {name: routes[name] for name in args.routes.split(',')}
+
+  from werkzeug.serving import WSGIRequestHandler, make_server
+
+  class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+      pass
+
+  server = make_server('127.0.0.1', 0, store.app, threaded=True,
+                       request_handler=QuietRequestHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  results = {
+    'commit': git_commit(),
+    'timestamp': datetime.now().isoformat(timespec='seconds'),
+    'scale': args.scale,
+    'seed': args.seed,
+    'python': sys.version.split()[0],
+    'sqlite': store.sqlite3.sqlite_version,
+    'routes': {}
+  }
+  print(f"{'route':18} {'mode':12} {'req/s':>8} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'p99 ms':>8} {'sql':>6}")
+  try:
+    for name, (admin, build) in routes.items():
+      rng = random.Random(f"{args.seed}-{name}")
+      modes = {
+        'test_client': run_test_client(store, name, admin, build,
+                                       args.requests, scale, rng),
+        'http': run_http(server.server_port, name, admin, build,
+                         args.requests, args.concurrency, scale, args.seed,
+                         store.SEED_PASSWORD),
+      }
+      results['routes'][name] = modes
+      for mode, result in modes.items():
+        print(f"{name:18} {mode:12} {result['throughput']:8} "
+              f"{result['p50_ms']:8} {result['p95_ms']:8} {result['p99_ms']:8} "
+              f"{result.get('sql_statements', ''):>6}")
+  finally:
+    server.shutdown()
+
+  output = args.output or os.path.join('benchmark-results',
+                                       f"{results['commit']}-{args.scale}.json")
+  os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+  with open(output, 'w') as output_file:
+    json.dump(results, output_file, indent=2)
+  print(f"\nresults written to {output}")
+  if args.compare:
+    compare(results, args.compare)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,9 @@
 #all imports
-import sqlite3, os, uuid
-from flask import Flask, render_template, request, session, redirect, url_for, g, make_response
-from datetime import datetime
-import matplotlib.pyplot as plt
+import sqlite3, os, uuid, threading, re, io, hashlib, json, time, csv, click, math
+from collections import OrderedDict
+from flask import Flask, render_template, request, session, redirect, url_for, g, make_response, jsonify, Response, stream_with_context, before_render_template, template_rendered, request_started, has_request_context
+from datetime import date, datetime, timedelta
+from markupsafe import Markup
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
@@ -11,44 +12,440 @@ app.secret_key = 'your_secret_key_here'
 app.config['UPLOAD_FOLDER'] = 'static/images'
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
 
+# resized variants generated for every upload: name -> max (width, height).
+# cards are shown at 250px, so they get twice that for high dpi screens
+app.config['IMAGE_VARIANTS'] = {'card': (500, 500)}
+# variants no longer generated whose files older uploads may still have
+RETIRED_IMAGE_VARIANTS = ('detail', )
+app.config['IMAGE_JPEG_QUALITY'] = 82
+app.config['IMAGE_WEBP'] = True
+
+# background jobs: whether each app process runs a worker thread (set it to
+# false when running 'flask run-jobs' separately), and the retry policy
+app.config['JOB_WORKER'] = True
+app.config['JOB_POLL_SECONDS'] = 1.0
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_TIMEOUT_SECONDS'] = 300
+app.config['JOB_RETENTION_DAYS'] = 7
+
+# database file, and whether pending schema migrations are applied at startup
+app.config['DATABASE'] = 'grocery_store.db'
+app.config['AUTO_MIGRATE'] = True
+
+# sqlite tuning: connections are pooled and reused across requests, so the
+# pragmas are paid once per connection instead of once per request
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
+app.config['DB_CACHE_SIZE_KB'] = 16384
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['DB_CACHED_STATEMENTS'] = 512
+
+# stock versions whose changed products are remembered. a process whose
+# catalog cache is older than that re-reads the stock of every product
+app.config['STOCK_CHANGES_KEPT'] = 1000
+
+# maximum number of products returned by a search, and the largest match set
+# still ranked by relevance. ranking scores every match, so broader searches
+# list their first matches by product id instead
+app.config['SEARCH_RESULT_LIMIT'] = 50
+app.config['SEARCH_RANK_LIMIT'] = 1000
+
+# orders per purchase history page, products per admin dashboard page
+app.config['HISTORY_PAGE_SIZE'] = 20
+app.config['ADMIN_PAGE_SIZE'] = 50
+
+# rows per transaction for bulk product import, rows per fetch for export
+app.config['IMPORT_BATCH_SIZE'] = 20000
+app.config['EXPORT_BATCH_SIZE'] = 5000
+
+# stock alerts on the insights page: products listed per alert, and how many
+# days ahead expiring products are listed by default
+app.config['STOCK_ALERT_LIMIT'] = 50
+app.config['EXPIRY_ALERT_DAYS'] = 7
+
+# rendered product cards kept in memory, least recently used dropped first.
+# a card is about 1.5 KB, so the default holds the busiest products in ~30 MB
+app.config['FRAGMENT_CACHE_SIZE'] = 20000
+
+# request, sql and template timings collected for /admin/metrics. when off,
+# connections are plain sqlite3 connections and the hooks return at once.
+# METRICS_TOKEN lets a scraper read the metrics without an admin session
+app.config['METRICS'] = False
+app.config['METRICS_TOKEN'] = None
+
+# statements slower than this many milliseconds (execute and fetch) are logged
+# with their query plan and listed on /admin/slow_queries. None, the default,
+# turns the slow query log off
+app.config['SLOW_QUERY_MS'] = None
+app.config['SLOW_QUERY_MAX_ENTRIES'] = 200
+
+# every setting above can be overridden from the environment, e.g. FLASK_DATABASE
+app.config.from_prefixed_env()
+
+
+# in-process prometheus style metrics: counters and histograms keyed by
+# label values. each gunicorn worker keeps and serves its own
+class Histogram:
+
+  def __init__(self, name, help_text, labels, buckets):
+    self.name = name
+    self.help_text = help_text
+    self.labels = labels
+    self.buckets = buckets
+    self.series = {}
+
+  def observe(self, label_values, value):
+    series = self.series.get(label_values)
+    if series is None:
+      series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+    for index, bound in enumerate(self.buckets):
+      if value <= bound:
+        series[0][index] += 1
+        break
+    series[1] += value
+    series[2] += 1
+
+  def render(self):
+    lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+    for label_values, (counts, total, count) in sorted(self.series.items()):
+      labels = ','.join(f'{label}="{value}"'
+                        for label, value in zip(self.labels, label_values))
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+      lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+      lines.append(f'{self.name}_sum{{{labels}}} {total}')
+      lines.append(f'{self.name}_count{{{labels}}} {count}')
+    return lines
+
+
+class Counter:
+
+  def __init__(self, name, help_text, labels):
+    self.name = name
+    self.help_text = help_text
+    self.labels = labels
+    self.series = {}
+
+  def inc(self, label_values, amount=1):
+    self.series[label_values] = self.series.get(label_values, 0) + amount
+
+  def render(self):
+    lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+    for label_values, value in sorted(self.series.items()):
+      labels = ','.join(f'{label}="{value}"'
+                        for label, value in zip(self.labels, label_values))
+      lines.append(f'{self.name}{{{labels}}} {value}')
+    return lines
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+metrics_lock = threading.Lock()
+request_latency = Histogram('grocery_request_duration_seconds',
+                            'Request latency by endpoint.',
+                            ('endpoint', 'method'), LATENCY_BUCKETS)
+request_count = Counter('grocery_requests_total', 'Requests by endpoint and status.',
+                        ('endpoint', 'method', 'status'))
+request_statements = Histogram('grocery_request_sql_statements',
+                               'SQL statements executed per request.',
+                               ('endpoint', ), STATEMENT_BUCKETS)
+request_sql_time = Histogram('grocery_request_sql_seconds',
+                             'Time spent executing SQL and fetching its rows per request.',
+                             ('endpoint', ), LATENCY_BUCKETS)
+template_render_time = Histogram('grocery_template_render_seconds',
+                                 'Template render time.', ('template', ),
+                                 LATENCY_BUCKETS)
+METRICS = (request_count, request_latency, request_statements, request_sql_time,
+           template_render_time)
+
+# sql statistics of the request running on this thread
+_request_stats = threading.local()
+
+
+def record_sql_time(elapsed, statement=False):
+  stats = getattr(_request_stats, 'current', None)
+  if stats is not None:
+    stats['statements'] += statement
+    stats['sql_seconds'] += elapsed
+
+
+# slow statements aggregated by their normalized sql: literals become ?,
+# lists of placeholders collapse and whitespace is squeezed
+SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+SQL_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+SQL_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+EXPLAINABLE_SQL = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\b',
+                             re.IGNORECASE)
+
+slow_queries = {}
+slow_queries_lock = threading.Lock()
+
+
+def normalize_sql(sql):
+  sql = SQL_NUMBER.sub('?', SQL_STRING.sub('?', sql))
+  return ' '.join(SQL_PLACEHOLDER_LIST.sub('(?, ...)', sql).split())
+
+
+# types (and string lengths) of the bound parameters, never their values
+def parameter_shape(parameters, many=False):
+  if many:
+    rows = parameters if isinstance(parameters, (list, tuple)) else None
+    if not rows:
+      return 'many'
+    return f"{len(rows)} x {parameter_shape(rows[0])}"
+
+  def shape(value):
+    if isinstance(value, (str, bytes)):
+      return f"{type(value).__name__}({len(value)})"
+    return 'None' if value is None else type(value).__name__
+
+  if isinstance(parameters, dict):
+    return '{' + ', '.join(f"{name}: {shape(value)}"
+                           for name, value in parameters.items()) + '}'
+  return '(' + ', '.join(shape(value) for value in parameters) + ')'
+
+
+# query plan rows as (detail, scan kind), from a plain cursor so explaining is
+# not traced itself. 'table' is a scan of every row of a table, 'index' a walk
+# of an index, usually for its order or as a covering index, None anything else
+def scan_kind(detail):
+  if not detail.startswith('SCAN ') or detail.startswith('SCAN CONSTANT'):
+    return None
+  if 'VIRTUAL TABLE INDEX' in detail:
+    return None
+  if ' USING ' in detail and ' INDEX' in detail:
+    return 'index'
+  return 'table'
+
+
+def explain_query_plan(connection, sql, parameters, many):
+  if not EXPLAINABLE_SQL.match(sql):
+    return []
+  if many:
+    rows = parameters if isinstance(parameters, (list, tuple)) else []
+    if not rows:
+      return []
+    parameters = rows[0]
+  try:
+    plan = sqlite3.Cursor(connection).execute(
+      'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+  except sqlite3.Error:
+    return []
+  return [(detail, scan_kind(detail)) for _, _, _, detail in plan]
+
+
+def record_slow_query(connection, sql, parameters, many, elapsed):
+  key = normalize_sql(sql)
+  new_entry = None
+  with slow_queries_lock:
+    entry = slow_queries.get(key)
+    if entry is None:
+      if len(slow_queries) >= app.config['SLOW_QUERY_MAX_ENTRIES']:
+        return
+      # the plan is captured once per normalized statement
+      plan = explain_query_plan(connection, sql, parameters, many)
+      entry = new_entry = slow_queries[key] = {
+        'sql': key, 'count': 0, 'total': 0.0, 'max': 0.0, 'plan': plan,
+        'full_scan': any(scan == 'table' for _, scan in plan)
+      }
+    entry['count'] += 1
+    entry['total'] += elapsed
+    entry['max'] = max(entry['max'], elapsed)
+    entry['last_seen'] = time.time()
+    entry['parameters'] = parameter_shape(parameters, many)
+    entry['endpoint'] = request.endpoint if has_request_context() else None
+  if new_entry is not None:
+    app.logger.warning("slow query (%.0f ms)%s: %s", elapsed * 1000,
+                       ' with full scan' if new_entry['full_scan'] else '', key)
+
+
+# connection and cursor classes used when metrics or the slow query log are
+# on. every statement, including those run through Connection.execute, goes
+# through the cursor. sqlite produces most rows while they are fetched, so a
+# statement's time runs from execute until its rows are exhausted, the next
+# statement on the cursor, or the cursor going away
+class InstrumentedCursor(sqlite3.Cursor):
+  # [sql, parameters, many, seconds] of the statement still being fetched
+  statement = None
+
+  def timed(self, method, *args):
+    started = time.perf_counter()
+    try:
+      return method(*args)
+    finally:
+      elapsed = time.perf_counter() - started
+      record_sql_time(elapsed)
+      if self.statement is not None:
+        self.statement[3] += elapsed
+
+  def start_statement(self, sql, parameters, many):
+    self.finish_statement()
+    record_sql_time(0.0, statement=True)
+    self.statement = [sql, parameters, many, 0.0]
+
+  def finish_statement(self):
+    statement, self.statement = self.statement, None
+    threshold = app.config['SLOW_QUERY_MS']
+    if (statement is not None and threshold is not None
+        and statement[3] * 1000 >= threshold):
+      sql, parameters, many, elapsed = statement
+      record_slow_query(self.connection, sql, parameters, many, elapsed)
+
+  def finish_without_rows(self):
+    if self.description is None:
+      self.finish_statement()
+
+  def execute(self, sql, parameters=()):
+    self.start_statement(sql, parameters, False)
+    try:
+      return self.timed(super().execute, sql, parameters)
+    finally:
+      self.finish_without_rows()
+
+  def executemany(self, sql, parameters):
+    if not isinstance(parameters, (list, tuple)):
+      parameters = list(parameters)
+    self.start_statement(sql, parameters, True)
+    try:
+      return self.timed(super().executemany, sql, parameters)
+    finally:
+      self.finish_without_rows()
+
+  def fetchone(self):
+    row = self.timed(super().fetchone)
+    if row is None:
+      self.finish_statement()
+    return row
+
+  def fetchmany(self, size=None):
+    size = self.arraysize if size is None else size
+    rows = self.timed(super().fetchmany, size)
+    if len(rows) < size:
+      self.finish_statement()
+    return rows
+
+  def fetchall(self):
+    rows = self.timed(super().fetchall)
+    self.finish_statement()
+    return rows
+
+  def __next__(self):
+    try:
+      return self.timed(super().__next__)
+    except StopIteration:
+      self.finish_statement()
+      raise
+
+  def close(self):
+    self.finish_statement()
+    super().close()
+
+  def __del__(self):
+    try:
+      self.finish_statement()
+    except sqlite3.Error:
+      pass
+
+
+class InstrumentedConnection(sqlite3.Connection):
+
+  def cursor(self, factory=InstrumentedCursor):
+    return super().cursor(factory)
+
+  def execute(self, sql, parameters=()):
+    return self.cursor().execute(sql, parameters)
+
+  def executemany(self, sql, parameters):
+    return self.cursor().executemany(sql, parameters)
+
+
+def connect_db():
+  db = sqlite3.connect(app.config['DATABASE'],
+                       timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                       cached_statements=app.config['DB_CACHED_STATEMENTS'],
+                       check_same_thread=False,
+                       factory=InstrumentedConnection
+                       if app.config['METRICS'] or app.config['SLOW_QUERY_MS'] is not None
+                       else sqlite3.Connection)
+  db.execute('PRAGMA journal_mode=WAL')
+  db.execute('PRAGMA synchronous=NORMAL')
+  db.execute(f"PRAGMA busy_timeout={int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+  db.execute(f"PRAGMA cache_size=-{int(app.config['DB_CACHE_SIZE_KB'])}")
+  db.execute(f"PRAGMA mmap_size={int(app.config['DB_MMAP_SIZE'])}")
+  db.execute('PRAGMA temp_store=MEMORY')
+  return db
+
+
+# keeps idle connections around for the next request. connections are handed
+# to one app context at a time, and dropped after a fork so gunicorn workers
+# never share a connection inherited from the master process
+class ConnectionPool:
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._idle = []
+    self._pid = os.getpid()
+
+  def acquire(self):
+    with self._lock:
+      if self._pid != os.getpid():
+        self._idle = []
+        self._pid = os.getpid()
+      if self._idle:
+        return self._idle.pop()
+    return connect_db()
+
+  def release(self, db):
+    if db.in_transaction:
+      db.rollback()
+    with self._lock:
+      if self._pid == os.getpid() and len(
+          self._idle) < app.config['DB_POOL_SIZE']:
+        self._idle.append(db)
+        return
+    db.close()
+
+
+db_pool = ConnectionPool()
+
 
 # making database connection
 def get_db():
   db = getattr(g, '_database', None)
   if db is None:
-    db = g._database = sqlite3.connect('grocery_store.db')
+    db = g._database = db_pool.acquire()
   return db
 
 
 @app.teardown_appcontext
 def close_db(error):
-  db = getattr(g, '_database', None)
+  db = g.pop('_database', None)
   if db is not None:
-    db.close()
+    db_pool.release(db)
 
 
-# initializing database and admin detail inserting
-def initialize_database():
-  with app.app_context():
-    db = get_db()
-    cursor = db.cursor()
-
-    # creating the users table
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+# schema migrations, applied in order and tracked with PRAGMA user_version.
+# never edit a migration once it has shipped, append a new one instead.
+MIGRATIONS = [
+  # 1: base tables and admin details
+  '''
+    CREATE TABLE IF NOT EXISTS users (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         username TEXT NOT NULL UNIQUE,
                         password TEXT NOT NULL,
                         is_admin INTEGER DEFAULT 0
-                        )''')
+                        );
 
-    # creating the Sections table for categories
-    cursor.execute('''CREATE TABLE IF NOT EXISTS sections (
+    CREATE TABLE IF NOT EXISTS sections (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         name TEXT NOT NULL UNIQUE,
                         image TEXT
-                        )''')
-    # creating the products table for products in specific categories
-    cursor.execute('''CREATE TABLE IF NOT EXISTS products (
+                        );
+
+    CREATE TABLE IF NOT EXISTS products (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         name TEXT NOT NULL,
                         manufacture_date DATE NULL,
@@ -59,18 +456,18 @@ def initialize_database():
                         section_id INTEGER,
                         image TEXT,
                         FOREIGN KEY (section_id) REFERENCES sections (id)
-                        )''')
-    # creating the user_cart table for products in users cart
-    cursor.execute('''CREATE TABLE IF NOT EXISTS user_cart (
+                        );
+
+    CREATE TABLE IF NOT EXISTS user_cart (
                         user_id INTEGER,
                         product_id INTEGER,
                         quantity INTEGER,
                         FOREIGN KEY (user_id) REFERENCES users (id),
                         FOREIGN KEY (product_id) REFERENCES products (id),
                         PRIMARY KEY (user_id, product_id)
-                        )''')
-    # creating the shopping_history table for users shopping history
-    cursor.execute('''CREATE TABLE IF NOT EXISTS shopping_history (
+                        );
+
+    CREATE TABLE IF NOT EXISTS shopping_history (
                         order_id TEXT,
                         user_id INTEGER,
                         product_id INTEGER,
@@ -78,19 +475,335 @@ def initialize_database():
                         purchase_date TEXT,
                         FOREIGN KEY (user_id) REFERENCES users (id),
                         FOREIGN KEY (product_id) REFERENCES products (id)
-                        )''')
+                        );
+
+    INSERT OR IGNORE INTO users (username, password, is_admin)
+    VALUES ('navjot', 'password', 1);
+  ''',
+  # 2: products are always listed per section
+  '''
+    CREATE INDEX IF NOT EXISTS idx_products_section ON products (section_id);
+  ''',
+  # 3: catalog version counters, bumped by every catalog write
+  '''
+    CREATE TABLE IF NOT EXISTS catalog_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL DEFAULT 0,
+                        stock_version INTEGER NOT NULL DEFAULT 0
+                        );
+
+    INSERT OR IGNORE INTO catalog_version (id) VALUES (1);
+  ''',
+  # 4: full-text search over product names, section names and units, kept in
+  # sync with products and sections by triggers
+  '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5 (
+                        name, section_name, unit,
+                        tokenize = 'unicode61 remove_diacritics 2',
+                        prefix = '2 3'
+                        );
+
+    INSERT INTO products_fts (products_fts, rank)
+    VALUES ('rank', 'bm25(10.0, 2.0, 1.0)');
+
+    INSERT INTO products_fts (rowid, name, section_name, unit)
+    SELECT p.id, p.name, COALESCE(s.name, ''), p.unit
+    FROM products p LEFT JOIN sections s ON s.id = p.section_id;
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+    BEGIN
+      INSERT INTO products_fts (rowid, name, section_name, unit)
+      VALUES (new.id, new.name,
+              COALESCE((SELECT name FROM sections WHERE id = new.section_id), ''),
+              new.unit);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_update
+    AFTER UPDATE OF name, unit, section_id ON products
+    BEGIN
+      UPDATE products_fts
+      SET name = new.name,
+          section_name = COALESCE(
+            (SELECT name FROM sections WHERE id = new.section_id), ''),
+          unit = new.unit
+      WHERE rowid = new.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+    BEGIN
+      DELETE FROM products_fts WHERE rowid = old.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS sections_fts_update
+    AFTER UPDATE OF name ON sections
+    BEGIN
+      UPDATE products_fts SET section_name = new.name
+      WHERE rowid IN (SELECT id FROM products WHERE section_id = new.id);
+    END;
+  ''',
+  # 5: price range searches, optionally within one section
+  '''
+    CREATE INDEX IF NOT EXISTS idx_products_price ON products (price, id);
+    CREATE INDEX IF NOT EXISTS idx_products_section_price
+    ON products (section_id, price);
+  ''',
+  # 6: sales rollup and store counters, maintained by checkout and signup
+  '''
+    CREATE TABLE IF NOT EXISTS product_sales (
+                        product_id INTEGER PRIMARY KEY,
+                        units_sold INTEGER NOT NULL DEFAULT 0,
+                        revenue REAL NOT NULL DEFAULT 0,
+                        last_sold TEXT,
+                        FOREIGN KEY (product_id) REFERENCES products (id)
+                        );
+
+    CREATE INDEX IF NOT EXISTS idx_product_sales_units
+    ON product_sales (units_sold DESC);
+
+    CREATE TABLE IF NOT EXISTS store_counters (
+                        name TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL DEFAULT 0
+                        );
+
+    INSERT INTO product_sales (product_id, units_sold, revenue, last_sold)
+    SELECT sh.product_id, SUM(sh.quantity), SUM(sh.quantity * p.price),
+           MAX(substr(sh.purchase_date, 7, 4) || '-' ||
+               substr(sh.purchase_date, 1, 2) || '-' ||
+               substr(sh.purchase_date, 4, 2) || substr(sh.purchase_date, 11))
+    FROM shopping_history sh JOIN products p ON p.id = sh.product_id
+    GROUP BY sh.product_id;
+
+    INSERT INTO store_counters (name, value)
+    SELECT 'registered_users', COUNT(*) FROM users WHERE is_admin = 0;
+  ''',
+  # 7: uploads are content addressed and may be shared, so deleting one
+  # looks up whether any other row still uses it
+  '''
+    CREATE INDEX IF NOT EXISTS idx_products_image ON products (image);
+    CREATE INDEX IF NOT EXISTS idx_sections_image ON sections (image);
+  ''',
+  # 8: background jobs (times are unix timestamps)
+  '''
+    CREATE TABLE IF NOT EXISTS jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        payload TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        last_error TEXT,
+                        run_after REAL NOT NULL,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                        );
+
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after);
+  ''',
+  # 9: sortable ISO-8601 purchase dates ('%m-%d-%Y %H:%M' -> '%Y-%m-%d %H:%M')
+  # and indexes for paging a user's history by order
+  '''
+    UPDATE shopping_history
+    SET purchase_date = substr(purchase_date, 7, 4) || '-' ||
+                        substr(purchase_date, 1, 2) || '-' ||
+                        substr(purchase_date, 4, 2) || substr(purchase_date, 11)
+    WHERE purchase_date GLOB '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]*';
+
+    CREATE INDEX IF NOT EXISTS idx_history_user_date
+    ON shopping_history (user_id, purchase_date, order_id);
+
+    CREATE INDEX IF NOT EXISTS idx_history_order ON shopping_history (order_id);
+  ''',
+  # 10: orders header table, and history lines that snapshot the product at
+  # purchase time. existing lines are backfilled from the current products,
+  # the best information there is for them
+  '''
+    CREATE TABLE IF NOT EXISTS orders (
+                        id TEXT PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        created_at TEXT NOT NULL,
+                        item_count INTEGER NOT NULL,
+                        total REAL NOT NULL,
+                        FOREIGN KEY (user_id) REFERENCES users (id)
+                        );
+
+    CREATE INDEX IF NOT EXISTS idx_orders_user
+    ON orders (user_id, created_at, id);
+
+    ALTER TABLE shopping_history ADD COLUMN product_name TEXT;
+    ALTER TABLE shopping_history ADD COLUMN unit_price REAL;
+    ALTER TABLE shopping_history ADD COLUMN unit TEXT;
+
+    UPDATE shopping_history
+    SET product_name = (SELECT name FROM products WHERE id = product_id),
+        unit_price = COALESCE(
+          (SELECT price FROM products WHERE id = product_id), 0),
+        unit = (SELECT unit FROM products WHERE id = product_id);
+
+    INSERT INTO orders (id, user_id, created_at, item_count, total)
+    SELECT order_id, user_id, MIN(purchase_date), SUM(quantity),
+           SUM(quantity * unit_price)
+    FROM shopping_history
+    GROUP BY order_id;
+  ''',
+  # 11: admin product listing by name prefix, name or stock, optionally
+  # within one section
+  '''
+    CREATE INDEX IF NOT EXISTS idx_products_name
+    ON products (name COLLATE NOCASE, id);
+    CREATE INDEX IF NOT EXISTS idx_products_stock
+    ON products (available_quantity, id);
+    CREATE INDEX IF NOT EXISTS idx_products_section_name
+    ON products (section_id, name COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS idx_products_section_stock
+    ON products (section_id, available_quantity);
+  ''',
+  # 12: per user cart version, the ETag of the cart api
+  '''
+    ALTER TABLE users ADD COLUMN cart_version INTEGER NOT NULL DEFAULT 0;
+  ''',
+  # 13: per product reorder thresholds, sortable ISO-8601 product dates
+  # ('%m-%d-%Y' -> '%Y-%m-%d', blank -> NULL) and partial covering indexes
+  # that hold only the products the stock alerts list
+  '''
+    ALTER TABLE products
+    ADD COLUMN reorder_threshold INTEGER NOT NULL DEFAULT 10;
+
+    UPDATE products SET manufacture_date = NULL
+    WHERE trim(manufacture_date) = '';
+    UPDATE products SET expiry_date = NULL WHERE trim(expiry_date) = '';
+
+    UPDATE products
+    SET manufacture_date = substr(manufacture_date, 7, 4) || '-' ||
+                           substr(manufacture_date, 1, 2) || '-' ||
+                           substr(manufacture_date, 4, 2)
+    WHERE manufacture_date GLOB '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]';
+    UPDATE products
+    SET expiry_date = substr(expiry_date, 7, 4) || '-' ||
+                      substr(expiry_date, 1, 2) || '-' ||
+                      substr(expiry_date, 4, 2)
+    WHERE expiry_date GLOB '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]';
+
+    CREATE INDEX IF NOT EXISTS idx_products_low_stock
+    ON products (available_quantity, name, reorder_threshold)
+    WHERE available_quantity <= reorder_threshold;
+    CREATE INDEX IF NOT EXISTS idx_products_expiry
+    ON products (expiry_date, name, available_quantity)
+    WHERE expiry_date IS NOT NULL AND available_quantity > 0;
+  ''',
+  # 14: products whose stock changed, by stock version, so caches refresh
+  # just those. only the last STOCK_CHANGES_KEPT versions are kept
+  '''
+    CREATE TABLE IF NOT EXISTS stock_changes (
+                        stock_version INTEGER NOT NULL,
+                        product_id INTEGER NOT NULL,
+                        PRIMARY KEY (stock_version, product_id)
+                        ) WITHOUT ROWID;
+  ''',
+  # 15: history pages read orders now, shopping_history is only looked up
+  # by order_id, so the per user index is just write overhead
+  '''
+    DROP INDEX IF EXISTS idx_history_user_date;
+  ''',
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class SchemaError(RuntimeError):
+  pass
+
+
+# splitting a migration script into single statements (trigger bodies included)
+def split_sql(script):
+  statement = ''
+  for part in script.split(';'):
+    statement += part + ';'
+    if sqlite3.complete_statement(statement):
+      if statement.strip(' \n;'):
+        yield statement.strip()
+      statement = ''
+
+
+def get_schema_version(db):
+  return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+# applying all pending migrations in one write transaction, so concurrent
+# workers starting up at the same time cannot apply a migration twice
+def migrate_database(db):
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    current = get_schema_version(db)
+    if current > SCHEMA_VERSION:
+      raise SchemaError(
+        f"Database schema version {current} is newer than this code "
+        f"({SCHEMA_VERSION}).")
+    for version in range(current + 1, SCHEMA_VERSION + 1):
+      migration = MIGRATIONS[version - 1]
+      if callable(migration):
+        migration(db)
+      else:
+        for statement in split_sql(migration):
+          db.execute(statement)
+      db.execute(f'PRAGMA user_version = {version}')
+    db.commit()
+  except BaseException:
+    db.rollback()
+    raise
+  return SCHEMA_VERSION - current
 
-    # Added admin details
-    cursor.execute(
-      '''INSERT OR IGNORE INTO users (username, password, is_admin) VALUES (?, ?, ?)''',
-      ('navjot', 'password', 1))
 
-    db.commit()
+def check_schema(db):
+  current = get_schema_version(db)
+  if current != SCHEMA_VERSION:
+    raise SchemaError(
+      f"Database schema is at version {current}, expected {SCHEMA_VERSION}. "
+      "Run 'flask --app main migrate' first.")
 
 
-@app.before_request
-def before_request():
-  initialize_database()
+# the app's own cli commands are found by importing this module, before the
+# command to run is known, so they check the schema when invoked instead
+class SchemaCheckedCommand(click.Command):
+
+  def invoke(self, ctx):
+    if not app.config['AUTO_MIGRATE']:
+      try:
+        check_schema(get_db())
+      except SchemaError as error:
+        raise click.ClickException(str(error))
+    return super().invoke(ctx)
+
+
+app.cli.command_class = SchemaCheckedCommand
+
+
+@app.cli.command('migrate', cls=click.Command)
+def migrate_command():
+  """Apply pending database schema migrations."""
+  applied = migrate_database(get_db())
+  print(f"Applied {applied} migration(s), schema is at version {SCHEMA_VERSION}.")
+
+
+# flask imports the app from the root 'flask' context to look up one of the
+# app's commands (see SchemaCheckedCommand), and from the command's own
+# context for built in ones such as 'flask run'
+def loading_for_app_command():
+  ctx = click.get_current_context(silent=True)
+  return ctx is not None and ctx.parent is None
+
+
+# bringing the schema up to date once at startup (or refusing to start on an
+# outdated one), the request path never runs DDL
+def init_schema():
+  with app.app_context():
+    db = get_db()
+    if app.config['AUTO_MIGRATE']:
+      migrate_database(db)
+    elif not (os.environ.get('FLASK_RUN_FROM_CLI') and
+              loading_for_app_command()):
+      check_schema(db)
+
+
+init_schema()
 
 
 def allowed_file(filename):
@@ -98,18 +811,365 @@ def allowed_file(filename):
     '.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
+# uploads are stored as <content hash>.<ext>, identical files share one copy
+CONTENT_ADDRESSED_IMAGE = re.compile(r'^[0-9a-f]{32}\.[a-z]+$')
+
+# uploaded originals (uuid or content hash names, no variants or site icons)
+UPLOADED_IMAGE = re.compile(r'^[0-9a-f-]{32,36}\.[a-z]+$')
+
+
+def image_path(filename):
+  return os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+
+def variant_filename(filename, variant, fmt):
+  return f"{os.path.splitext(filename)[0]}.{variant}.{fmt}"
+
+
+# saving an uploaded image under its content hash. its variants are generated
+# by a background job, enqueued in the caller's transaction
+def save_image_upload(image, cursor):
+  data = image.read()
+  extension = os.path.splitext(image.filename)[1].lower()
+  if extension == '.jpeg':
+    extension = '.jpg'
+  filename = hashlib.sha256(data).hexdigest()[:32] + extension
+
+  path = image_path(filename)
+  if not os.path.exists(path):
+    temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temporary_path, 'wb') as file:
+      file.write(data)
+    os.replace(temporary_path, path)
+
+  enqueue_job(cursor, 'image_variants', {'filename': filename})
+  return filename
+
+
+# writing the resized/recompressed variants of a stored upload. variants that
+# already exist (a duplicate upload) are kept. until they exist, or when Pillow
+# is missing, the original keeps being served instead. returns whether any
+# variant was written
+def generate_image_variants(filename):
+  try:
+    from PIL import Image, ImageOps
+  except ImportError:
+    app.logger.warning("Pillow is not installed, no image variants generated")
+    return False
+
+  written = False
+
+  with Image.open(image_path(filename)) as original:
+    original = ImageOps.exif_transpose(original)
+    if original.mode in ('RGBA', 'LA', 'P'):
+      original = original.convert('RGBA')
+      flattened = Image.new('RGB', original.size, (255, 255, 255))
+      flattened.paste(original, mask=original.getchannel('A'))
+    else:
+      flattened = original.convert('RGB')
+
+    formats = ['jpg', 'webp'] if app.config['IMAGE_WEBP'] else ['jpg']
+    for variant, size in app.config['IMAGE_VARIANTS'].items():
+      resized = None
+      for fmt in formats:
+        path = image_path(variant_filename(filename, variant, fmt))
+        if os.path.exists(path):
+          continue
+        if resized is None:
+          resized = flattened.copy()
+          resized.thumbnail(size, Image.LANCZOS)
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        if fmt == 'webp':
+          resized.save(temporary_path, 'WEBP', quality=80, method=4)
+        else:
+          resized.save(temporary_path,
+                       'JPEG',
+                       quality=app.config['IMAGE_JPEG_QUALITY'],
+                       optimize=True,
+                       progressive=True)
+        os.replace(temporary_path, path)
+        written = True
+  return written
+
+
+# deleting an upload and its variants once no section or product uses it
+def delete_image_if_unused(filename):
+  if not filename:
+    return
+  if '/' in filename or '\\' in filename or '..' in filename:
+    app.logger.warning("not deleting image %r outside the upload folder",
+                       filename)
+    return
+  in_use = get_db().execute(
+    '''SELECT 1 FROM products WHERE image = ?
+       UNION ALL SELECT 1 FROM sections WHERE image = ? LIMIT 1''',
+    (filename, filename)).fetchone()
+  if in_use:
+    return
+
+  paths = [image_path(filename)]
+  for variant in (*app.config['IMAGE_VARIANTS'], *RETIRED_IMAGE_VARIANTS):
+    paths += [
+      image_path(variant_filename(filename, variant, fmt))
+      for fmt in ('jpg', 'webp')
+    ]
+  for path in paths:
+    if os.path.exists(path):
+      os.remove(path)
+  _existing_variants.difference_update(paths)
+
+
+_existing_variants = set()
+
+
+# url of a generated variant, or None if there is none (yet)
+@app.template_global()
+def image_variant_url(filename, variant, fmt='jpg'):
+  if not filename or not CONTENT_ADDRESSED_IMAGE.match(filename):
+    return None
+  name = variant_filename(filename, variant, fmt)
+  path = image_path(name)
+  if path not in _existing_variants:
+    if not os.path.exists(path):
+      return None
+    _existing_variants.add(path)
+  return url_for('static', filename='images/' + name)
+
+
+# url templates use for an image, preferring the requested variant and
+# falling back to the original upload (e.g. images uploaded before variants)
+@app.template_global()
+def image_url(filename, variant=None):
+  if variant:
+    url = image_variant_url(filename, variant)
+    if url:
+      return url
+  return url_for('static', filename='images/' + filename)
+
+
+
+
+# background jobs: deferred work is written to the jobs table in the same
+# transaction as the change that needs it, and picked up by a worker thread
+# (or a separate 'flask run-jobs' process). failed jobs are retried with
+# exponential backoff until JOB_MAX_ATTEMPTS
+JOB_HANDLERS = {}
+
+
+def job_handler(kind):
+
+  def register(function):
+    JOB_HANDLERS[kind] = function
+    return function
+
+  return register
+
+
+def enqueue_job(cursor, kind, payload, delay=0):
+  now = time.time()
+  cursor.execute(
+    '''INSERT INTO jobs (kind, payload, run_after, created_at, updated_at)
+       VALUES (?, ?, ?, ?, ?)''', (kind, json.dumps(payload), now + delay, now, now))
+
+
+# taking the next due job, also re-queueing jobs whose worker died mid-run
+def claim_job(db):
+  now = time.time()
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    db.execute(
+      '''UPDATE jobs SET status = 'pending', updated_at = ?
+         WHERE status = 'running' AND updated_at < ?''',
+      (now, now - app.config['JOB_TIMEOUT_SECONDS']))
+    job = db.execute(
+      '''SELECT id, kind, payload, attempts FROM jobs
+         WHERE status = 'pending' AND run_after <= ?
+         ORDER BY run_after LIMIT 1''', (now, )).fetchone()
+    if job:
+      db.execute(
+        '''UPDATE jobs SET status = 'running', attempts = attempts + 1,
+           updated_at = ? WHERE id = ?''', (now, job[0]))
+    db.commit()
+  except BaseException:
+    db.rollback()
+    raise
+  return job
+
+
+def finish_job(db, job_id, error=None, attempts=0):
+  now = time.time()
+  if error is None:
+    db.execute(
+      "UPDATE jobs SET status = 'done', last_error = NULL, updated_at = ? WHERE id = ?",
+      (now, job_id))
+  elif attempts >= app.config['JOB_MAX_ATTEMPTS']:
+    db.execute(
+      "UPDATE jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+      (error, now, job_id))
+  else:
+    db.execute(
+      '''UPDATE jobs SET status = 'pending', last_error = ?, run_after = ?,
+         updated_at = ? WHERE id = ?''', (error, now + 2**attempts, now, job_id))
+  db.commit()
+
+
+# running one due job, returns False when there was nothing to do
+def run_next_job():
+  db = get_db()
+  job = claim_job(db)
+  if job is None:
+    return False
+
+  job_id, kind, payload, attempts = job
+  try:
+    handler = JOB_HANDLERS[kind]
+    handler(**json.loads(payload))
+  except Exception as error:
+    if db.in_transaction:
+      db.rollback()
+    app.logger.warning("job %s (%s) failed: %r", job_id, kind, error)
+    finish_job(db, job_id, error=repr(error), attempts=attempts + 1)
+  else:
+    finish_job(db, job_id)
+  return True
+
+
+def purge_finished_jobs(db):
+  db.execute("DELETE FROM jobs WHERE status = 'done' AND updated_at < ?",
+             (time.time() - app.config['JOB_RETENTION_DAYS'] * 86400, ))
+  db.commit()
+
+
+def job_worker_loop():
+  last_purge = 0
+  while True:
+    ran = False
+    try:
+      with app.app_context():
+        ran = run_next_job()
+        if not ran and time.time() - last_purge > 3600:
+          purge_finished_jobs(get_db())
+          last_purge = time.time()
+    except Exception:
+      app.logger.exception("job worker error")
+    if not ran:
+      time.sleep(app.config['JOB_POLL_SECONDS'])
+
+
+_job_worker_pid = None
+_job_worker_lock = threading.Lock()
+
+
+# starting this process's worker thread. checked per request, because threads
+# do not survive a fork (gunicorn --preload)
+@app.before_request
+def start_job_worker():
+  global _job_worker_pid
+  if _job_worker_pid == os.getpid() or not app.config['JOB_WORKER']:
+    return
+  with _job_worker_lock:
+    if _job_worker_pid != os.getpid():
+      threading.Thread(target=job_worker_loop, name='job-worker',
+                       daemon=True).start()
+      _job_worker_pid = os.getpid()
+
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+  """Run the background job worker in the foreground."""
+  job_worker_loop()
+
+
+@job_handler('image_variants')
+def image_variants_job(filename):
+  # the image may have been replaced and deleted in the meantime
+  if os.path.exists(image_path(filename)) and generate_image_variants(filename):
+    # cached cards of the products showing it still point at the original.
+    # a stock bump for just those products renders them again, sections
+    # (rarely uploaded) need a full catalog bump
+    db = get_db()
+    cursor = db.cursor()
+    product_ids = [
+      row[0] for row in cursor.execute(
+        "SELECT id FROM products WHERE image = ?", (filename, ))
+    ]
+    if product_ids:
+      bump_catalog_version(cursor, stock_product_ids=product_ids)
+    if cursor.execute("SELECT 1 FROM sections WHERE image = ? LIMIT 1",
+                      (filename, )).fetchone():
+      bump_catalog_version(cursor)
+    db.commit()
+
+
+@job_handler('delete_images')
+def delete_images_job(filenames):
+  for filename in filenames:
+    delete_image_if_unused(filename)
+
+
+# uploaded images are never modified in place (uuid or content hash names)
+IMMUTABLE_IMAGE = re.compile(
+  r'^images/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+  r'|[0-9a-f]{32}(\.[a-z]+)?)\.[a-z]+$')
+IMMUTABLE_CACHE_SECONDS = 365 * 24 * 60 * 60
+
+_static_fingerprints = {}
+
+
+# short content hash of a static file, recomputed only when it changes on disk
+def static_fingerprint(filename):
+  path = os.path.join(app.static_folder, filename)
+  try:
+    mtime = os.stat(path).st_mtime
+  except OSError:
+    return None
+  cached = _static_fingerprints.get(filename)
+  if cached is None or cached[0] != mtime:
+    with open(path, 'rb') as file:
+      cached = (mtime, hashlib.md5(file.read()).hexdigest()[:12])
+    _static_fingerprints[filename] = cached
+  return cached[1]
+
+
+# adding ?v=<fingerprint> to static urls (css etc.), so they can be cached
+# forever and still change when the file does
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+  if endpoint == 'static' and 'v' not in values:
+    filename = values.get('filename', '')
+    if not IMMUTABLE_IMAGE.match(filename):
+      fingerprint = static_fingerprint(filename)
+      if fingerprint:
+        values['v'] = fingerprint
+
+
+def is_immutable_static(filename):
+  return bool(IMMUTABLE_IMAGE.match(filename)) or (
+    request.args.get('v') is not None
+    and request.args.get('v') == static_fingerprint(filename))
 
 
 # ensures that all routes in the app will return the appropriate CORS headers.
 
 def add_cors_headers(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag')
     response.headers.add('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
     return response
 
 @app.after_request
 def after_request(response):
+    # static files keep their ETag/304 handling from send_file, and get long
+    # lived cache headers when their url can never point to other content
+    if request.endpoint == 'static':
+        if response.status_code in (200, 304) and is_immutable_static(
+                request.view_args.get('filename', '')):
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_CACHE_SECONDS
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return response
     if request.method == 'OPTIONS':
         return add_cors_headers(make_response())
     return add_cors_headers(response)
@@ -167,6 +1227,7 @@ def signup():
     # inserting new user into the database
     cursor.execute('''INSERT INTO users (username, password) VALUES (?, ?)''',
                    (username, password))
+    increment_counter(cursor, 'registered_users')
     get_db().commit()
 
     return render_template('signup.html',
@@ -198,18 +1259,38 @@ def admin_login():
   return render_template('admin_login.html')
 
 
+# product listing filters of the admin dashboard, as query string arguments
+def admin_product_filters(args):
+  filters = {
+    'section_id': int_arg(args, 'section_id'),
+    'q': args.get('q', '').strip() or None,
+    'sort': args.get('sort') if args.get('sort') in PRODUCT_SORTS else None,
+    'order': 'desc' if args.get('order') == 'desc' else None
+  }
+  return {name: value for name, value in filters.items() if value is not None}
+
+
 # Admin Dashboard
 @app.route('/admin/dashboard')
 def admin_dashboard():
   if 'admin_id' in session:
-    # fetch sections and products
-    cursor = get_db().cursor()
-    sections = cursor.execute("SELECT id, name FROM sections").fetchall()
-    products = cursor.execute(
-      "SELECT id, name, price, unit, available_quantity, section_id FROM products"
-    ).fetchall()
+    # fetch sections and one page of products
+    filters = admin_product_filters(request.args)
+    sort = filters.get('sort', 'name')
+    products, next_cursor = find_products(
+      section_id=filters.get('section_id'),
+      name_prefix=filters.get('q'),
+      sort=sort,
+      descending=filters.get('order') == 'desc',
+      after=parse_product_cursor(request.args.get('after'), sort),
+      limit=app.config['ADMIN_PAGE_SIZE'])
+    # only ids and names for the filter, the catalog cache is reloaded after
+    # every admin write and is not worth rebuilding for that
+    sections = get_db().execute(
+      "SELECT id, name FROM sections ORDER BY id").fetchall()
 
     # converting results to a list of dictionaries
+    section_names = {section[0]: section[1] for section in sections}
     sections_list = [{
       'id': section[0],
       'name': section[1]
@@ -217,16 +1298,23 @@ def admin_dashboard():
     products_list = [{
       'id': product[0],
       'name': product[1],
-      'price': product[2],
-      'unit': product[3],
-      'available_quantity': product[4],
-      'section_id': product[5]
+      'price': product[4],
+      'unit': product[5],
+      'available_quantity': product[6],
+      'section_id': product[7],
+      'section_name': section_names.get(product[7])
     } for product in products]
 
+    # the product table loads further pages incrementally from the json variant
+    if request.args.get('format') == 'json':
+      return jsonify(products=products_list, next=next_cursor)
+
     # passing the data to the template context
     return render_template('admin_dashboard.html',
                            sections=sections_list,
-                           products=products_list)
+                           products=products_list,
+                           filters=filters,
+                           next_cursor=next_cursor)
 
   return redirect(url_for('admin_login'))
 
@@ -249,8 +1337,7 @@ def add_category():
           error_message=f"A category with the name '{name}' already exists.")
       # for uploading category image
       if image and allowed_file(image.filename):
-        filename = str(uuid.uuid4()) + os.path.splitext(image.filename)[1]
-        image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        filename = save_image_upload(image, cursor)
       else:
         return render_template('add_category.html',
                                error_message="image extension not allowed")
@@ -258,6 +1345,7 @@ def add_category():
       cursor = get_db().cursor()
       cursor.execute('''INSERT INTO sections (name, image) VALUES (?, ?)''',
                      (name, filename))
+      bump_catalog_version(cursor)
       get_db().commit()
 
       return redirect(url_for('admin_dashboard'))
@@ -284,16 +1372,8 @@ def edit_category(category_id):
       # Check if the user uploaded a new image
       if image:
         if allowed_file(image.filename):
-          # Delete the previous image
-          if category[1]:
-            previous_image_path = os.path.join(app.config['UPLOAD_FOLDER'],
-                                               category[1])
-            if os.path.exists(previous_image_path):
-              os.remove(previous_image_path)
-
           # Save the new image
-          filename = str(uuid.uuid4()) + os.path.splitext(image.filename)[1]
-          image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+          filename = save_image_upload(image, cursor)
         else:
           return render_template('edit_category.html',
                                  category=category,
@@ -315,6 +1395,10 @@ def edit_category(category_id):
       # Update the category in the database
       cursor.execute("UPDATE sections SET name=?, image=? WHERE id=?",
                      (name, filename, category_id))
+      bump_catalog_version(cursor)
+      # Delete the previous image in the background once nothing uses it
+      if category[1] != filename:
+        enqueue_job(cursor, 'delete_images', {'filenames': [category[1]]})
       get_db().commit()
 
       # Redirect to the admin dashboard
@@ -335,31 +1419,23 @@ def remove_category(category_id):
                    (category_id, ))
     category = cursor.fetchone()
 
-    cursor.execute("SELECT image FROM products WHERE section_id=?",
-                   (category_id, ))
-    product_images = cursor.fetchall()
-
     if request.method == 'POST':
+      product_images = [
+        row[0] for row in cursor.execute(
+          "SELECT DISTINCT image FROM products WHERE section_id=?",
+          (category_id, ))
+      ]
+
       # Remove the category from the database
       cursor.execute("DELETE FROM sections WHERE id=?", (category_id, ))
       cursor.execute("DELETE FROM products WHERE section_id=?",
                      (category_id, ))
-      get_db().commit()
-
-      # Delete the images of sections associated with the deleted category
-      if category[1]:
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], category[1])
-        if os.path.exists(image_path):
-          os.remove(image_path)
+      bump_catalog_version(cursor)
 
-      # Delete the images of products associated with the deleted category
-
-      for product_image in product_images:
-        if product_image[0]:
-          product_image_path = os.path.join(app.config['UPLOAD_FOLDER'],
-                                            product_image[0])
-          if os.path.exists(product_image_path):
-            os.remove(product_image_path)
+      # Delete the images of the category and its products in the background
+      enqueue_job(cursor, 'delete_images',
+                  {'filenames': [category[1]] + product_images})
+      get_db().commit()
 
       return redirect(url_for('admin_dashboard'))
 
@@ -378,13 +1454,26 @@ def add_product():
 
     if request.method == 'POST':
       name = request.form['name']
-      manufacture_date = request.form['manufacture_date']
-      expiry_date = request.form['expiry_date']
       price = request.form['price']
       unit = request.form['unit']
       available_quantity = request.form['available_quantity']
       section_id = request.form['section_id']
       image = request.files['image']
+      try:
+        reorder_threshold = non_negative_int(
+          request.form.get('reorder_threshold') or 10)
+      except ValueError:
+        return render_template(
+          'add_product.html',
+          error_message="Reorder threshold must be a whole number, 0 or more.",
+          sections=sections)
+      try:
+        manufacture_date = optional_date(request.form['manufacture_date'])
+        expiry_date = optional_date(request.form['expiry_date'])
+      except ValueError:
+        return render_template('add_product.html',
+                               error_message="Dates must be YYYY-MM-DD.",
+                               sections=sections)
       cursor = get_db().cursor()
       cursor.execute("SELECT id FROM products WHERE name=?", (name, ))
       existing_product = cursor.fetchone()
@@ -396,8 +1485,7 @@ def add_product():
           sections=sections)
 
       if image and allowed_file(image.filename):
-        filename = str(uuid.uuid4()) + os.path.splitext(image.filename)[1]
-        image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        filename = save_image_upload(image, cursor)
       else:
         return render_template('add_product.html',
                                error_message="image extension not allowed",
@@ -405,10 +1493,11 @@ def add_product():
 
       cursor = get_db().cursor()
       cursor.execute(
-        '''INSERT INTO products (name, manufacture_date, expiry_date, price, unit, available_quantity, section_id, image) 
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        '''INSERT INTO products (name, manufacture_date, expiry_date, price, unit, available_quantity, reorder_threshold, section_id, image) 
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
         (name, manufacture_date, expiry_date, price, unit, available_quantity,
-         section_id, filename))
+         reorder_threshold, section_id, filename))
+      bump_catalog_version(cursor)
       get_db().commit()
 
       return redirect(url_for('admin_dashboard'))
@@ -430,27 +1519,34 @@ def edit_product(product_id):
     if request.method == 'POST':
       # Get form data
       name = request.form['name']
-      manufacture_date = request.form['manufacture_date']
-      expiry_date = request.form['expiry_date']
       price = request.form['price']
       unit = request.form['unit']
       available_quantity = request.form['available_quantity']
       section_id = request.form['section_id']
       image = request.files['image']
+      try:
+        reorder_threshold = non_negative_int(
+          request.form.get('reorder_threshold') or product[9])
+      except ValueError:
+        return render_template(
+          'edit_product.html',
+          product=product,
+          sections=sections,
+          error_message="Reorder threshold must be a whole number, 0 or more.")
+      try:
+        manufacture_date = optional_date(request.form['manufacture_date'])
+        expiry_date = optional_date(request.form['expiry_date'])
+      except ValueError:
+        return render_template('edit_product.html',
+                               product=product,
+                               sections=sections,
+                               error_message="Dates must be YYYY-MM-DD.")
 
       # Checking if the user uploaded a new image
       if image:
         if allowed_file(image.filename):
-          # Delete the previous image
-          if product[8]:
-            previous_image_path = os.path.join(app.config['UPLOAD_FOLDER'],
-                                               product[8])
-            if os.path.exists(previous_image_path):
-              os.remove(previous_image_path)
-
           # Save the new image
-          filename = str(uuid.uuid4()) + os.path.splitext(image.filename)[1]
-          image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+          filename = save_image_upload(image, cursor)
         else:
           return render_template('edit_product.html',
                                  product=product,
@@ -476,10 +1572,16 @@ def edit_product(product_id):
         '''
                     UPDATE products SET
                     name=?, manufacture_date=?, expiry_date=?, price=?, unit=?,
-                    available_quantity=?, section_id=?, image=?
+                    available_quantity=?, reorder_threshold=?, section_id=?,
+                    image=?
                     WHERE id=?
                 ''', (name, manufacture_date, expiry_date, price, unit,
-                      available_quantity, section_id, filename, product_id))
+                      available_quantity, reorder_threshold, section_id,
+                      filename, product_id))
+      bump_catalog_version(cursor)
+      # Delete the previous image in the background once nothing uses it
+      if product[8] != filename:
+        enqueue_job(cursor, 'delete_images', {'filenames': [product[8]]})
       get_db().commit()
 
       # Redirect to the admin dashboard
@@ -504,13 +1606,10 @@ def remove_product(product_id):
     if request.method == 'POST':
       # Remove the product from the database
       cursor.execute('''DELETE FROM products WHERE id=?''', (product_id, ))
+      bump_catalog_version(cursor)
+      enqueue_job(cursor, 'delete_images', {'filenames': [product[1]]})
       get_db().commit()
 
-      if product[1]:
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], product[1])
-        if os.path.exists(image_path):
-          os.remove(image_path)
-
       # Redirect to the admin dashboard
       return redirect(url_for('admin_dashboard'))
 
@@ -519,15 +1618,521 @@ def remove_product(product_id):
   return render_template('admin_login.html')
 
 
+# columns of bulk product files (csv header / jsonl keys). products refer to
+# their section by name
+PRODUCT_FILE_COLUMNS = [
+  'name', 'manufacture_date', 'expiry_date', 'price', 'unit',
+  'available_quantity', 'section', 'image', 'reorder_threshold'
+]
+IMPORT_MAX_ERRORS = 100
+
+
+# streaming (line number, row dict) pairs out of a csv or jsonl text stream
+def read_product_rows(stream, file_format):
+  if file_format == 'jsonl':
+    for line_number, line in enumerate(stream, start=1):
+      if not line.strip():
+        continue
+      try:
+        row = json.loads(line)
+      except ValueError:
+        row = None
+      yield line_number, row if isinstance(row, dict) else None
+  else:
+    reader = csv.DictReader(stream)
+    for row in reader:
+      yield reader.line_num, row
+
+
+ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def optional_date(value):
+  value = str(value or '').strip()
+  if not value:
+    return None
+  if not ISO_DATE.match(value):
+    raise ValueError(value)
+  datetime.fromisoformat(value)
+  return value
+
+
+# a whole number of 0 or more from a form field or file, raises ValueError
+def non_negative_int(value):
+  number = value if isinstance(value, int) else int(str(value).strip())
+  if number < 0:
+    raise ValueError(f"{value!r} is negative")
+  return number
+
+
+# validating one imported row into an insert tuple, raises ValueError
+def parse_product_row(row, section_ids):
+  name = str(row.get('name') or '').strip()
+  unit = str(row.get('unit') or '').strip()
+  if not name or not unit:
+    raise ValueError("name and unit are required")
+  price = float(row.get('price'))
+  if not math.isfinite(price):
+    raise ValueError("price must be a finite number")
+  available_quantity = int(row.get('available_quantity'))
+  if price < 0 or available_quantity < 0:
+    raise ValueError("price and available_quantity must not be negative")
+  section_id = section_ids.get(str(row.get('section') or '').strip())
+  if section_id is None:
+    raise ValueError(f"unknown section {row.get('section')!r}")
+  try:
+    manufacture_date = optional_date(row.get('manufacture_date'))
+    expiry_date = optional_date(row.get('expiry_date'))
+  except ValueError:
+    raise ValueError("dates must be YYYY-MM-DD")
+  # only names of files already uploaded, never paths
+  image = str(row.get('image') or '').strip() or None
+  if image is not None and not (UPLOADED_IMAGE.match(image) and
+                                os.path.isfile(image_path(image))):
+    raise ValueError(f"unknown image {image!r}")
+  reorder_threshold = row.get('reorder_threshold')
+  try:
+    reorder_threshold = 10 if reorder_threshold in (None, '') else (
+      non_negative_int(reorder_threshold))
+  except ValueError:
+    raise ValueError("reorder_threshold must be a whole number, 0 or more")
+  return (name, manufacture_date, expiry_date, price, unit,
+          available_quantity, section_id, image, reorder_threshold)
+
+
+# the whole batch goes in as one statement: fts5 flushes its pending index
+# data at every statement boundary, so executemany (one statement per row,
+# each firing products_fts_insert) runs about ten times slower
+def insert_product_batch(db, batch):
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    db.execute(
+      '''INSERT INTO products (name, manufacture_date, expiry_date, price, unit,
+         available_quantity, section_id, image, reorder_threshold)
+         SELECT value ->> 0, value ->> 1, value ->> 2, value ->> 3, value ->> 4,
+                value ->> 5, value ->> 6, value ->> 7, value ->> 8
+         FROM json_each(?)''',
+      (json.dumps(batch),))
+    bump_catalog_version(db.cursor())
+    db.commit()
+  except BaseException:
+    db.rollback()
+    raise
+
+
+# bulk importing products from a csv/jsonl text stream. rows are validated and
+# inserted in batches of IMPORT_BATCH_SIZE, one transaction per batch, so
+# memory stays flat however big the file is. names that already exist are
+# skipped like in add_product
+def import_products(stream, file_format):
+  db = get_db()
+  section_ids = dict(db.execute("SELECT name, id FROM sections"))
+  existing_names = {row[0] for row in db.execute("SELECT name FROM products")}
+  result = {'inserted': 0, 'skipped': 0, 'errors': [], 'error_count': 0}
+
+  def reject(line_number, message):
+    result['error_count'] += 1
+    if len(result['errors']) < IMPORT_MAX_ERRORS:
+      result['errors'].append((line_number, message))
+
+  batch = []
+  for line_number, row in read_product_rows(stream, file_format):
+    if row is None:
+      reject(line_number, "not a JSON object")
+      continue
+    try:
+      product = parse_product_row(row, section_ids)
+    except (TypeError, ValueError, OverflowError) as error:
+      reject(line_number, str(error))
+      continue
+    if product[0] in existing_names:
+      result['skipped'] += 1
+      continue
+    existing_names.add(product[0])
+    batch.append(product)
+    if len(batch) >= app.config['IMPORT_BATCH_SIZE']:
+      insert_product_batch(db, batch)
+      result['inserted'] += len(batch)
+      batch = []
+
+  if batch:
+    insert_product_batch(db, batch)
+    result['inserted'] += len(batch)
+  return result
+
+
+# streaming the catalog as csv/jsonl text chunks, one chunk per fetchmany batch
+def export_products(file_format):
+  cursor = get_db().cursor()
+  cursor.execute('''
+    SELECT p.name, p.manufacture_date, p.expiry_date, p.price, p.unit,
+           p.available_quantity, s.name, p.image, p.reorder_threshold
+    FROM products p LEFT JOIN sections s ON s.id = p.section_id
+    ORDER BY p.id''')
+
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  if file_format == 'csv':
+    writer.writerow(PRODUCT_FILE_COLUMNS)
+  while True:
+    rows = cursor.fetchmany(app.config['EXPORT_BATCH_SIZE'])
+    if not rows:
+      break
+    if file_format == 'jsonl':
+      for row in rows:
+        buffer.write(json.dumps(dict(zip(PRODUCT_FILE_COLUMNS, row))))
+        buffer.write('\n')
+    else:
+      writer.writerows(rows)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+  if buffer.tell():
+    yield buffer.getvalue()
+
+
+def product_file_format(filename):
+  return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+# Product Management - Bulk import from a csv/jsonl upload
+@app.route('/admin/import_products', methods=['GET', 'POST'])
+def import_products_route():
+  if 'admin_id' in session:
+    if request.method == 'POST':
+      upload = request.files.get('file')
+      if not upload or not upload.filename:
+        return render_template('import_products.html',
+                               error_message="Choose a CSV or JSONL file.")
+      stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+      result = import_products(stream, product_file_format(upload.filename))
+      return render_template('import_products.html', result=result)
+
+    return render_template('import_products.html')
+
+  return redirect(url_for('admin_login'))
+
+
+# Product Management - Streaming catalog export
+@app.route('/admin/export_products')
+def export_products_route():
+  if 'admin_id' in session:
+    file_format = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    mimetype = 'application/x-ndjson' if file_format == 'jsonl' else 'text/csv'
+    response = Response(stream_with_context(export_products(file_format)),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = (
+      f'attachment; filename=products.{file_format}')
+    return response
+
+  return redirect(url_for('admin_login'))
+
+
+@app.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']))
+def import_products_command(path, file_format):
+  """Bulk import products from a CSV or JSONL file."""
+  started = time.perf_counter()
+  with open(path, encoding='utf-8-sig', newline='') as stream:
+    result = import_products(stream, file_format or product_file_format(path))
+  elapsed = time.perf_counter() - started
+  for line_number, message in result['errors']:
+    print(f"line {line_number}: {message}")
+  print(f"Inserted {result['inserted']}, skipped {result['skipped']} existing, "
+        f"{result['error_count']} invalid rows in {elapsed:.1f}s.")
+
+
+@app.cli.command('export-products')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']),
+              default='csv')
+@click.option('--output', '-o', type=click.File('w'), default='-')
+def export_products_command(file_format, output):
+  """Stream the product catalog as CSV or JSONL."""
+  for chunk in export_products(file_format):
+    output.write(chunk)
+
+
+# synthetic data for scale testing. every value is derived from the row number
+# and the seed by an integer hash in sql, so a seed always builds the same
+# database and no row passes through python
+SEED_SCALES = {
+  'tiny': dict(sections=10, products=1000, users=200, history=10000),
+  'small': dict(sections=100, products=20000, users=5000, history=200000),
+  'medium': dict(sections=300, products=100000, users=20000, history=1000000),
+  'large': dict(sections=1000, products=200000, users=50000, history=5000000),
+}
+SEED_PASSWORD = 'password'
+SEED_UNITS = ['Rs/Kg', 'Rs/Litre', 'Rs/Unit', 'Rs/Dozen']
+SEED_TABLES = ('sections', 'products', 'users', 'user_cart', 'orders',
+               'shopping_history')
+# every 50th seeded product is sold out
+SEED_OUT_OF_STOCK = 49
+
+
+# sql expression of a pseudo random 24 bit integer from an integer expression:
+# two multiply-xorshift rounds keeping the well mixed high bits, with
+# multipliers small enough that no product leaves sqlite's 64 bit integers
+def seeded_random(expression, salt):
+  mixed = f"(((({expression}) + {salt}) % 4294967296) * 73244475 % 4294967296)"
+  shifted = f"({mixed} >> 16)"
+  # sqlite has no xor: a ^ b = (a | b) - (a & b)
+  return (f"((({mixed} | {shifted}) - ({mixed} & {shifted})) * 73244475 "
+          f"% 4294967296 >> 8)")
+
+
+def seed_rows(count):
+  return f"""WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n
+             WHERE i < {int(count)})"""
+
+
+# filling an empty store with sections, products (images from a pool of
+# existing files), users, carts and three years of orders. runs in one
+# transaction with the indexes and triggers of the seeded tables dropped
+# first and rebuilt once at the end, which is much cheaper than maintaining
+# them row by row
+def seed_store(db, sections, products, users, history, seed, images):
+  salt = lambda n: seed * 1000003 + n
+  rand = lambda expression, n: seeded_random(expression, salt(n))
+  # history lines derive these from the product id too, instead of a lookup
+  price = lambda product: f"(500 + {rand(product, 4)} % 49500) / 100.0"
+  unit = lambda product: (f"(SELECT name FROM temp.seed_units "
+                          f"WHERE id = {rand(product, 5)} % {len(SEED_UNITS)})")
+
+  db.execute('PRAGMA cache_size = -262144')
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    for table in SEED_TABLES:
+      filled = db.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {table}"
+        f"{' WHERE is_admin = 0' if table == 'users' else ''})").fetchone()[0]
+      if filled:
+        raise ValueError(f"table {table} is not empty, seed an empty database")
+
+    dropped = db.execute(
+      f'''SELECT type, name, sql FROM sqlite_master
+         WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+         AND tbl_name IN ({', '.join('?' * len(SEED_TABLES))})''',
+      SEED_TABLES).fetchall()
+    for kind, name, _ in dropped:
+      db.execute(f'DROP {kind.upper()} {name}')
+
+    db.execute("CREATE TEMP TABLE seed_images (id INTEGER PRIMARY KEY, name TEXT)")
+    db.executemany("INSERT INTO temp.seed_images VALUES (?, ?)",
+                   enumerate(images))
+    db.execute("CREATE TEMP TABLE seed_units (id INTEGER PRIMARY KEY, name TEXT)")
+    db.executemany("INSERT INTO temp.seed_units VALUES (?, ?)",
+                   enumerate(SEED_UNITS))
+
+    db.execute(f'''{seed_rows(sections)}
+      INSERT INTO sections (id, name, image)
+      SELECT i, 'Section ' || i,
+             (SELECT name FROM temp.seed_images WHERE id = {rand('i', 1)} % {len(images)})
+      FROM n''')
+
+    db.execute(f'''{seed_rows(products)}
+      INSERT INTO products (id, name, manufacture_date, expiry_date, price, unit,
+                            available_quantity, section_id, image)
+      SELECT i, 'Product ' || i,
+             date('2024-01-01', '+' || ({rand('i', 2)} % 365) || ' days'),
+             date('2025-01-01', '+' || ({rand('i', 3)} % 730) || ' days'),
+             {price('i')}, {unit('i')},
+             CASE WHEN (i - 1) % 50 = {SEED_OUT_OF_STOCK} THEN 0
+                  ELSE 100 + {rand('i', 6)} % 9900 END,
+             1 + {rand('i', 7)} % {sections},
+             (SELECT name FROM temp.seed_images WHERE id = {rand('i', 8)} % {len(images)})
+      FROM n''')
+
+    # users are named user0, user1, ... after the admin
+    first_user = db.execute(
+      "SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+    db.execute(f'''{seed_rows(users)}
+      INSERT INTO users (id, username, password, is_admin)
+      SELECT {first_user} + i - 1, 'user' || (i - 1), ?, 0 FROM n''',
+               (SEED_PASSWORD, ))
+
+    # up to three cart lines per user, sold out picks move to the previous
+    # product
+    cart_product = f"({rand('i', 9)} % {products})"
+    db.execute(f'''{seed_rows(users * 3)}
+      INSERT OR IGNORE INTO user_cart (user_id, product_id, quantity)
+      SELECT {first_user} + (i - 1) / 3,
+             1 + {cart_product} - ({cart_product} % 50 = {SEED_OUT_OF_STOCK}),
+             1 + {rand('i', 10)} % 3
+      FROM n WHERE {rand('i', 11)} % 2 = 0''')
+
+    # orders of one to five lines over 2022-2024. orders come in pairs of six
+    # lines, so the order of every line follows from its number and the
+    # history has exactly the requested length. times are minutes since
+    # 2022-01-01, turned into text through small day and time tables
+    db.execute('''CREATE TEMP TABLE seed_days (id INTEGER PRIMARY KEY, day TEXT)''')
+    db.execute(f'''{seed_rows(1096)}
+      INSERT INTO temp.seed_days
+      SELECT i - 1, date('2022-01-01', '+' || (i - 1) || ' days') FROM n''')
+    db.execute('''CREATE TEMP TABLE seed_times (id INTEGER PRIMARY KEY, time TEXT)''')
+    db.execute(f'''{seed_rows(1440)}
+      INSERT INTO temp.seed_times
+      SELECT i - 1, printf('%02d:%02d', (i - 1) / 60, (i - 1) % 60) FROM n''')
+    stamp_text = '''(SELECT day FROM temp.seed_days WHERE id = {0} / 1440) || ' ' ||
+                    (SELECT time FROM temp.seed_times WHERE id = {0} % 1440)'''
+
+    # lines are keyed by order, so orders are summed without sorting
+    order_no = f"(2 * ((i - 1) / 6) + ((i - 1) % 6 > {rand('(i - 1) / 6', 14)} % 5))"
+    db.execute('''CREATE TEMP TABLE seed_lines (
+                    order_no INTEGER, line INTEGER, user_id INTEGER,
+                    stamp INTEGER, product_id INTEGER, quantity INTEGER,
+                    price REAL,
+                    PRIMARY KEY (order_no, line)) WITHOUT ROWID''')
+    db.execute(f'''{seed_rows(history)},
+      line AS MATERIALIZED (SELECT i, {order_no} AS order_no,
+                                   1 + {rand('i', 15)} % {products} AS product_id
+                            FROM n)
+      INSERT INTO temp.seed_lines
+      SELECT order_no, i, {first_user} + {rand('order_no', 12)} % {users},
+             {rand('order_no', 13)} % 1578240, product_id, 1 + {rand('i', 16)} % 5,
+             {price('product_id')}
+      FROM line''')
+
+    db.execute(f'''
+      INSERT INTO shopping_history (order_id, user_id, product_id, quantity,
+                                    purchase_date, product_name, unit_price, unit)
+      SELECT 'S{seed}-' || order_no, user_id, product_id, quantity,
+             {stamp_text.format('stamp')}, 'Product ' || product_id, price,
+             {unit('product_id')}
+      FROM temp.seed_lines''')
+    db.execute(f'''
+      INSERT INTO orders (id, user_id, created_at, item_count, total)
+      SELECT 'S{seed}-' || order_no, user_id, {stamp_text.format('stamp')},
+             item_count, total
+      FROM (SELECT order_no, MIN(user_id) AS user_id, MIN(stamp) AS stamp,
+                   SUM(quantity) AS item_count, SUM(quantity * price) AS total
+            FROM temp.seed_lines GROUP BY order_no)''')
+    # the sales rollup of rebuild_sales_rollup, from the narrow seed lines
+    # rather than the wide history rows
+    db.execute(f'''
+      INSERT INTO product_sales (product_id, units_sold, revenue, last_sold)
+      SELECT product_id, units_sold, revenue, {stamp_text.format('last_stamp')}
+      FROM (SELECT product_id, SUM(quantity) AS units_sold,
+                   SUM(quantity * price) AS revenue,
+                   MAX(stamp) AS last_stamp
+            FROM temp.seed_lines GROUP BY product_id)''')
+    db.execute('''
+      INSERT OR REPLACE INTO store_counters (name, value)
+      SELECT 'registered_users', COUNT(*) FROM users WHERE is_admin = 0''')
+    for table in ('seed_lines', 'seed_days', 'seed_times'):
+      db.execute(f"DROP TABLE temp.{table}")
+    db.execute("DROP TABLE temp.seed_images")
+    db.execute("DROP TABLE temp.seed_units")
+
+    for _, _, sql in dropped:
+      db.execute(sql)
+    db.execute('''
+      INSERT INTO products_fts (rowid, name, section_name, unit)
+      SELECT p.id, p.name, COALESCE(s.name, ''), p.unit
+      FROM products p LEFT JOIN sections s ON s.id = p.section_id''')
+    bump_catalog_version(db.cursor())
+    db.commit()
+  except BaseException:
+    db.rollback()
+    raise
+  finally:
+    db.execute(f"PRAGMA cache_size=-{int(app.config['DB_CACHE_SIZE_KB'])}")
+  db.execute('ANALYZE')
+
+
+# the pool seeded images are picked from
+def seed_image_pool(folder):
+  if not os.path.isdir(folder):
+    return []
+  return sorted(name for name in os.listdir(folder) if UPLOADED_IMAGE.match(name))
+
+
+@app.cli.command('seed')
+@click.option('--scale', type=click.Choice(list(SEED_SCALES)), default='tiny')
+@click.option('--seed', 'seed', type=int, default=1)
+@click.option('--sections', type=int, help='Override the scale.')
+@click.option('--products', type=int, help='Override the scale.')
+@click.option('--users', type=int, help='Override the scale.')
+@click.option('--history', type=int, help='Override the scale.')
+def seed_command(scale, seed, **overrides):
+  """Fill an empty database with deterministic synthetic data."""
+  counts = dict(SEED_SCALES[scale],
+                **{name: value for name, value in overrides.items() if value})
+  images = seed_image_pool(app.config['UPLOAD_FOLDER'])
+  if not images:
+    raise click.ClickException(
+      f"No images in {app.config['UPLOAD_FOLDER']} to pick from.")
+  started = time.perf_counter()
+  try:
+    seed_store(get_db(), seed=seed, images=images, **counts)
+  except ValueError as error:
+    raise click.ClickException(str(error))
+  print(f"Seeded {counts} in {time.perf_counter() - started:.1f}s.")
+
+
+# store wide counters, updated in the same transaction as the rows they count
+def increment_counter(cursor, name, amount=1):
+  cursor.execute(
+    '''INSERT INTO store_counters (name, value) VALUES (?, ?)
+       ON CONFLICT (name) DO UPDATE SET value = value + excluded.value''',
+    (name, amount))
+
+
+def fetch_counter(name):
+  row = get_db().execute("SELECT value FROM store_counters WHERE name = ?",
+                         (name, )).fetchone()
+  return row[0] if row else 0
+
+
+# adding sold lines (product_id, quantity, unit_price) to the sales rollup,
+# inside the checkout transaction
+def record_sales(cursor, lines, sold_at):
+  cursor.executemany(
+    '''INSERT INTO product_sales (product_id, units_sold, revenue, last_sold)
+       VALUES (?, ?, ?, ?)
+       ON CONFLICT (product_id) DO UPDATE SET
+         units_sold = units_sold + excluded.units_sold,
+         revenue = revenue + excluded.revenue,
+         last_sold = excluded.last_sold''',
+    [(product_id, quantity, quantity * unit_price, sold_at)
+     for product_id, quantity, unit_price in lines])
+
+
+# recomputing the sales rollup and counters from scratch, for backfills
+def rebuild_sales_rollup(db):
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    db.execute("DELETE FROM product_sales")
+    db.execute('''
+      INSERT INTO product_sales (product_id, units_sold, revenue, last_sold)
+      SELECT product_id, SUM(quantity), SUM(quantity * unit_price),
+             MAX(purchase_date)
+      FROM shopping_history
+      GROUP BY product_id''')
+    db.execute('''
+      INSERT OR REPLACE INTO store_counters (name, value)
+      SELECT 'registered_users', COUNT(*) FROM users WHERE is_admin = 0''')
+    db.commit()
+  except BaseException:
+    db.rollback()
+    raise
+
+
+@app.cli.command('rebuild-sales')
+def rebuild_sales_command():
+  """Recompute the sales rollup and store counters from the history."""
+  rebuild_sales_rollup(get_db())
+  print("Sales rollup rebuilt.")
+
+
 # Functions for showing graphs in insights page
 def fetch_most_sold_products():
   cursor = get_db().cursor()
   most_sold_query = '''
-        SELECT p.name, SUM(sh.quantity) AS total_sold
-        FROM products p
-        JOIN shopping_history sh ON p.id = sh.product_id
-        GROUP BY p.id
-        ORDER BY total_sold DESC
+        SELECT p.name, s.units_sold
+        FROM product_sales s
+        JOIN products p ON p.id = s.product_id
+        ORDER BY s.units_sold DESC
         LIMIT 5
     '''
   most_sold_products = cursor.execute(most_sold_query).fetchall()
@@ -535,23 +2140,92 @@ def fetch_most_sold_products():
 
 
 def fetch_registered_users_count():
+  return fetch_counter('registered_users')
+
+
+# stock alerts. the WHERE clauses repeat those of the partial indexes
+# idx_products_low_stock and idx_products_expiry word for word, so sqlite
+# reads only the alerting products, straight out of the index
+def fetch_low_stock_products(limit):
   cursor = get_db().cursor()
-  registered_users_query = '''
-        SELECT COUNT(*) FROM users WHERE is_admin = 0
+  low_stock_query = '''
+        SELECT name, available_quantity, reorder_threshold
+        FROM products
+        WHERE available_quantity <= reorder_threshold
+        ORDER BY available_quantity, name
+        LIMIT ?
     '''
-  registered_users_count = cursor.execute(registered_users_query).fetchone()[0]
-  return registered_users_count
+  low_stock_products = cursor.execute(low_stock_query, (limit, )).fetchall()
+  low_stock_count = cursor.execute('''
+        SELECT COUNT(*) FROM products
+        WHERE available_quantity <= reorder_threshold''').fetchone()[0]
+  return low_stock_products, low_stock_count
 
 
-def fetch_low_quantity_products():
+# in stock products expired or expiring within the next days days
+def fetch_expiring_products(days, limit):
   cursor = get_db().cursor()
-  low_quantity_query = '''
-        SELECT name, available_quantity
+  until = (date.today() + timedelta(days=days)).isoformat()
+  expiring_query = '''
+        SELECT name, expiry_date, available_quantity
         FROM products
-        WHERE available_quantity <= 10
+        WHERE expiry_date IS NOT NULL AND available_quantity > 0
+          AND expiry_date <= ?
+        ORDER BY expiry_date, name
+        LIMIT ?
     '''
-  low_quantity_products = cursor.execute(low_quantity_query).fetchall()
-  return low_quantity_products
+  expiring_products = cursor.execute(expiring_query, (until, limit)).fetchall()
+  expiring_count = cursor.execute('''
+        SELECT COUNT(*) FROM products
+        WHERE expiry_date IS NOT NULL AND available_quantity > 0
+          AND expiry_date <= ?''', (until, )).fetchone()[0]
+  return expiring_products, expiring_count
+
+
+# rendered charts by data key. the data is tiny, so a handful of entries
+# covers every admin looking at the page between two sales
+_chart_cache = {}
+_chart_cache_lock = threading.Lock()
+CHART_CACHE_SIZE = 16
+
+
+def chart_key(most_sold_products):
+  return hashlib.sha1(repr(most_sold_products).encode()).hexdigest()[:16]
+
+
+# drawing the Most Sold Products bar chart as png bytes with the object
+# oriented api on the Agg backend, so concurrent requests never share state
+def render_most_sold_chart(most_sold_products):
+  # imported here so workers that never draw a chart don't pay for matplotlib
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+  figure = Figure(figsize=(8, 6))
+  FigureCanvasAgg(figure)
+  axes = figure.subplots()
+  products = [product[0] for product in most_sold_products]
+  quantities = [product[1] for product in most_sold_products]
+  axes.bar(products, quantities)
+  axes.set_xlabel('Products')
+  axes.set_ylabel('Quantity Sold')
+  axes.set_title('Most Sold Products')
+
+  buffer = io.BytesIO()
+  figure.savefig(buffer, format='png')
+  return buffer.getvalue()
+
+
+def get_most_sold_chart(most_sold_products):
+  key = chart_key(most_sold_products)
+  with _chart_cache_lock:
+    png = _chart_cache.get(key)
+  if png is None:
+    png = render_most_sold_chart(most_sold_products)
+    with _chart_cache_lock:
+      if len(_chart_cache) >= CHART_CACHE_SIZE:
+        _chart_cache.pop(next(iter(_chart_cache)))
+      _chart_cache[key] = png
+  return key, png
 
 
 #Route to show the graphs and details in insight page
@@ -560,25 +2234,40 @@ def admin_insights():
   if 'admin_id' in session:
     most_sold_products = fetch_most_sold_products()
     registered_users_count = fetch_registered_users_count()
-    low_quantity_products = fetch_low_quantity_products()
-
-    # Generate the Most Sold Products Bar Chart
-    plt.figure(figsize=(8, 6))
-    products = [product[0] for product in most_sold_products]
-    quantities = [product[1] for product in most_sold_products]
-    plt.bar(products, quantities)
-    plt.xlabel('Products')
-    plt.ylabel('Quantity Sold')
-    plt.title('Most Sold Products')
-    most_sold_chart_path = os.path.join(app.config['UPLOAD_FOLDER'],
-                                        'most_sold_chart.png')
-    plt.savefig(most_sold_chart_path)
-    plt.clf()  # Clear the current figure
+    limit = app.config['STOCK_ALERT_LIMIT']
+    low_stock_products, low_stock_count = fetch_low_stock_products(limit)
+    expiry_days = int_arg(request.args, 'days')
+    if expiry_days is None or expiry_days < 0:
+      expiry_days = app.config['EXPIRY_ALERT_DAYS']
+    expiring_products, expiring_count = fetch_expiring_products(
+      expiry_days, limit)
 
     return render_template('admin_insights.html',
-                           most_sold_chart=most_sold_chart_path,
+                           most_sold_chart_key=chart_key(most_sold_products),
                            registered_users_count=registered_users_count,
-                           low_quantity_products=low_quantity_products)
+                           low_stock_products=low_stock_products,
+                           low_stock_count=low_stock_count,
+                           expiring_products=expiring_products,
+                           expiring_count=expiring_count,
+                           expiry_days=expiry_days,
+                           today=date.today().isoformat())
+
+  return redirect(url_for('admin_login'))
+
+
+# Most Sold Products chart image. the url carries the data key, so a chart
+# can be cached by the browser until the sales change
+@app.route('/admin/insights/most_sold_chart.png')
+def most_sold_chart():
+  if 'admin_id' in session:
+    key, png = get_most_sold_chart(fetch_most_sold_products())
+    response = make_response(png)
+    response.content_type = 'image/png'
+    response.set_etag(key)
+    if request.args.get('v') == key:
+      response.cache_control.private = True
+      response.cache_control.max_age = 86400
+    return response.make_conditional(request)
 
   return redirect(url_for('admin_login'))
 
@@ -610,6 +2299,7 @@ def update_cart_item(user_id, product_id, quantity):
   cursor.execute(
     "UPDATE user_cart SET quantity=? WHERE user_id=? AND product_id=?",
     (quantity, user_id, product_id))
+  bump_cart_version(cursor, user_id)
   get_db().commit()
 
 
@@ -631,25 +2321,243 @@ def update_cart_item_route():
         cursor.execute(
           "UPDATE user_cart SET quantity=? WHERE user_id=? AND product_id=?",
           (quantity, user_id, product_id))
+      bump_cart_version(cursor, user_id)
       get_db().commit()
 
   return redirect(url_for('user_dashboard'))
 
 
-def get_cart_items(user_id):
-  cursor = get_db().cursor()
-  cart_items = cursor.execute(
+# product_id -> quantity of the user's cart, built once per request so
+# templates look quantities up in constant time
+def fetch_cart_quantities(user_id):
+  return dict(get_db().execute(
     "SELECT product_id, quantity FROM user_cart WHERE user_id = ?",
-    (user_id, )).fetchall()
-  return cart_items
+    (user_id, )))
+
+
+# every cart write bumps the user's cart version in the same transaction
+def bump_cart_version(cursor, user_id):
+  cursor.execute(
+    "UPDATE users SET cart_version = cart_version + 1 WHERE id = ?",
+    (user_id, ))
+
+
+# product columns in the order the templates index them
+PRODUCT_COLUMNS = '''id, name, manufacture_date, expiry_date, price, unit,
+  available_quantity, section_id, image'''
+
+
+# loading all sections and their products with two set-based queries,
+# grouped in a single pass instead of one products query per section
+def load_catalog():
+  cursor = get_db().cursor()
+  sections = cursor.execute(
+    "SELECT id, name, image FROM sections ORDER BY id").fetchall()
 
+  products_by_section = {section[0]: [] for section in sections}
+  cursor.execute(
+    f"SELECT {PRODUCT_COLUMNS} FROM products ORDER BY section_id, id")
+  for product in cursor:
+    section_products = products_by_section.get(product[7])
+    if section_products is not None:
+      section_products.append(product)
+
+  return sections, products_by_section
+
+
+# every catalog write bumps the version row inside its own transaction, so
+# the in-process catalog caches of all workers notice it with one cheap read.
+# stock_product_ids is for writes that change nothing but the
+# available_quantity of those products
+def bump_catalog_version(cursor, stock_product_ids=None):
+  if stock_product_ids is not None:
+    stock_version = cursor.execute(
+      '''UPDATE catalog_version SET stock_version = stock_version + 1
+         WHERE id = 1 RETURNING stock_version''').fetchone()[0]
+    cursor.execute(
+      '''INSERT OR IGNORE INTO stock_changes (stock_version, product_id)
+         SELECT ?, value FROM json_each(?)''',
+      (stock_version, json.dumps(list(stock_product_ids))))
+    cursor.execute("DELETE FROM stock_changes WHERE stock_version <= ?",
+                   (stock_version - app.config['STOCK_CHANGES_KEPT'], ))
+  else:
+    cursor.execute(
+      "UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+
+
+def fetch_catalog_version():
+  return get_db().execute(
+    "SELECT version, stock_version FROM catalog_version WHERE id = 1"
+  ).fetchone()
 
-# Function to get the quantity of a product in the user's cart
-def get_cart_quantity(product_id, user_cartt):
-  for cart_item in user_cartt:
-    if cart_item[1] == product_id:
-      return cart_item[2]
-  return 0
+
+def index_products(products_by_section):
+  return {
+    product[0]: product
+    for products in products_by_section.values() for product in products
+  }
+
+
+_catalog_cache = {'version': None, 'stock_version': None}
+_catalog_lock = threading.Lock()
+
+
+# copying fresh stock levels into the cached products, without re-reading
+# names, images and prices. every listed product gets a new tuple, so its
+# cached card is rendered again. only the products recorded in stock_changes since
+# the cached version are read, unless some of those versions have no record
+# (already pruned, or a bump without product ids)
+def refresh_catalog_stock(catalog, stock_version):
+  cursor = get_db().cursor()
+  changes = cursor.execute(
+    '''SELECT c.stock_version, p.id, p.available_quantity
+       FROM stock_changes c JOIN products p ON p.id = c.product_id
+       WHERE c.stock_version > ? AND c.stock_version <= ?''',
+    (catalog['stock_version'], stock_version)).fetchall()
+  if len({change[0] for change in changes}) == stock_version - catalog['stock_version']:
+    quantities = {product_id: quantity for _, product_id, quantity in changes}
+  else:
+    quantities = dict(
+      cursor.execute("SELECT id, available_quantity FROM products"))
+
+  # sections without a changed product keep their lists
+  products_by_id = dict(catalog['products_by_id'])
+  products_by_section = dict(catalog['products_by_section'])
+  changed_sections = {
+    products_by_id[product_id][7]
+    for product_id in quantities if product_id in products_by_id
+  }
+  for section_id in changed_sections:
+    refreshed = []
+    for product in products_by_section[section_id]:
+      if product[0] in quantities:
+        product = product[:6] + (quantities[product[0]], ) + product[7:]
+        products_by_id[product[0]] = product
+      refreshed.append(product)
+    products_by_section[section_id] = refreshed
+  return products_by_section, products_by_id
+
+
+# cached catalog of this process, rebuilt when the catalog version changes and
+# only stock refreshed when just the stock version changed. cached objects are
+# never mutated (except the fragment memos), a refresh swaps in a new dict
+def get_catalog():
+  global _catalog_cache
+  version, stock_version = fetch_catalog_version()
+  catalog = _catalog_cache
+  if catalog['version'] == version and catalog[
+      'stock_version'] == stock_version:
+    return catalog
+
+  with _catalog_lock:
+    catalog = _catalog_cache
+    db = get_db()
+    # read versions and rows in one snapshot so they always match
+    snapshot = not db.in_transaction
+    if snapshot:
+      db.execute('BEGIN')
+    try:
+      version, stock_version = fetch_catalog_version()
+      if catalog['version'] == version:
+        # another thread may have refreshed it while this one waited
+        if catalog['stock_version'] != stock_version:
+          products_by_section, products_by_id = refresh_catalog_stock(
+            catalog, stock_version)
+          catalog = dict(catalog,
+                         stock_version=stock_version,
+                         products_by_section=products_by_section,
+                         products_by_id=products_by_id)
+      else:
+        sections, products_by_section = load_catalog()
+        catalog = {
+          'version': version,
+          'stock_version': stock_version,
+          'sections': sections,
+          'products_by_section': products_by_section,
+          'products_by_id': index_products(products_by_section),
+          'fragments': OrderedDict(),
+          'section_strip': None
+        }
+    finally:
+      if snapshot:
+        db.commit()
+    _catalog_cache = catalog
+
+  return catalog
+
+
+# rendered html shared by all users, memoized in the catalog's fragments
+# dict. a new catalog version starts an empty dict, a stock refresh keeps it:
+# a card is keyed by product id and only reused while the cached product
+# tuple is the very one in the catalog, which stops being true when a stock
+# refresh lists the product. the per user parts are rendered into slots, markup
+# that autoescaped catalog text can never contain, and filled in per request
+CART_QUANTITY_SLOT = '<cart-quantity/>'
+REMOVE_BUTTON_SLOT = '<remove-button/>'
+PRODUCT_ID_SLOT = '<product-id/>'
+_fragments_lock = threading.Lock()
+_remove_button = None
+
+
+def product_card_fragments(product):
+  card = render_template('product_card.html',
+                         product=product,
+                         cart_quantity=Markup(CART_QUANTITY_SLOT),
+                         remove_button=Markup(REMOVE_BUTTON_SLOT))
+  head, rest = card.split(CART_QUANTITY_SLOT)
+  middle, tail = rest.split(REMOVE_BUTTON_SLOT)
+  return product, head, middle, tail
+
+
+# the Remove form only differs by product id, rendered once around an id slot
+def remove_button(product_id):
+  global _remove_button
+  if _remove_button is None:
+    _remove_button = render_template('product_card_remove.html',
+                                     product=(Markup(PRODUCT_ID_SLOT), )).split(
+                                       PRODUCT_ID_SLOT)
+  before, after = _remove_button
+  return before + str(int(product_id)) + after
+
+
+@app.template_global()
+def product_card(product, cart_quantity):
+  catalog = _catalog_cache
+  fragments = catalog.get('fragments')
+  # pages read straight from products carry equal copies of catalog tuples
+  current = catalog.get('products_by_id', {}).get(product[0])
+  if current is not product and current == product:
+    product = current
+  cached = None
+  if fragments is not None:
+    with _fragments_lock:
+      cached = fragments.get(product[0])
+      if cached is not None and cached[0] is product:
+        fragments.move_to_end(product[0])
+  if cached is None or cached[0] is not product:
+    cached = product_card_fragments(product)
+    if fragments is not None and current == product:
+      with _fragments_lock:
+        fragments[product[0]] = cached
+        fragments.move_to_end(product[0])
+        while len(fragments) > app.config['FRAGMENT_CACHE_SIZE']:
+          fragments.popitem(last=False)
+  _, head, middle, tail = cached
+  return Markup(''.join((head, str(cart_quantity), middle,
+                         remove_button(product[0]) if cart_quantity else '',
+                         tail)))
+
+
+@app.template_global()
+def section_strip(sections):
+  catalog = _catalog_cache
+  strip = catalog.get('section_strip')
+  if strip is None or strip[0] is not sections:
+    strip = sections, Markup(
+      render_template('section_strip.html', sections=sections))
+    if catalog.get('sections') is sections:
+      catalog['section_strip'] = strip
+  return strip[1]
 
 
 # route for User dashboard
@@ -660,29 +2568,165 @@ def user_dashboard():
     cursor = get_db().cursor()
     current_user = cursor.execute('''SELECT * FROM users WHERE id=?''',
                                   (user_id, )).fetchone()
-    sections = cursor.execute("SELECT * FROM sections").fetchall()
-
-    products_by_section = {}
-    for section in sections:
-      section_id = section[0]
-      cursor.execute("SELECT * FROM products WHERE section_id=?",
-                     (section_id, ))
-      products = cursor.fetchall()
-      products_by_section[section_id] = products
-
-    user_cartt = cursor.execute("SELECT * FROM user_cart WHERE user_id=?",
-                                (user_id, )).fetchall()
+    catalog = get_catalog()
 
     return render_template('user_dashboard.html',
                            current_user=current_user,
-                           sections=sections,
-                           products_by_section=products_by_section,
-                           user_cartt=user_cartt,
-                           get_cart_quantity=get_cart_quantity)
+                           sections=catalog['sections'],
+                           products_by_section=catalog['products_by_section'],
+                           cart_quantities=fetch_cart_quantities(user_id))
 
   return redirect(url_for('login'))
 
 
+# turning free text into an fts5 prefix query limited to the given columns.
+# only word characters are kept, so user input can never inject fts syntax
+def fts_query(text, columns):
+  terms = re.findall(r'\w+', text)
+  if not terms:
+    return None
+  return '{%s} : (%s)' % (' '.join(columns), ' AND '.join(
+    f'"{term}"*' for term in terms))
+
+
+# ids of products matching the query in the given columns, best match first.
+# the matches are counted up to the rank limit first, unranked, which stops
+# early; a broader match set keeps that product id order
+def search_product_ids(search_query, columns, limit):
+  match = fts_query(search_query, columns)
+  if match is None:
+    return []
+  cursor = get_db().cursor()
+  rank_limit = app.config['SEARCH_RANK_LIMIT']
+  cursor.execute(
+    '''SELECT rowid FROM products_fts
+       WHERE products_fts MATCH ?
+       LIMIT ?''', (match, rank_limit + 1))
+  product_ids = [row[0] for row in cursor]
+  if not product_ids or len(product_ids) > rank_limit:
+    return product_ids[:limit]
+  cursor.execute(
+    '''SELECT rowid FROM products_fts
+       WHERE products_fts MATCH ?
+       ORDER BY rank
+       LIMIT ?''', (match, limit))
+  return [row[0] for row in cursor]
+
+
+# parsing an optional number from the query string, ignoring bad input
+def float_arg(args, name):
+  try:
+    return float(args[name])
+  except (KeyError, ValueError):
+    return None
+
+
+def int_arg(args, name):
+  try:
+    return int(args[name])
+  except (KeyError, ValueError):
+    return None
+
+
+# product sort orders: name -> (sql expression, position in the product
+# tuple, type of the keyset value)
+PRODUCT_SORTS = {
+  'price': ('price', 4, float),
+  'name': ('name COLLATE NOCASE', 1, str),
+  'stock': ('available_quantity', 6, int),
+}
+
+
+# keyset cursor "<sort value>:<id>" of the last product on a page
+def parse_product_cursor(value, sort='price'):
+  try:
+    key, product_id = value.rsplit(':', 1)
+    return PRODUCT_SORTS[sort][2](key), int(product_id)
+  except (AttributeError, KeyError, ValueError):
+    return None
+
+
+def escape_like(value):
+  return re.sub(r'([\\%_])', r'\\\1', value)
+
+
+# structured product search by price range, section and name prefix, sorted by
+# price, name or stock and paginated with a (sort value, id) keyset, so every
+# page is a bounded index range. returns the page and the cursor of the next
+# page (None on the last one)
+def find_products(min_price=None,
+                  max_price=None,
+                  section_id=None,
+                  name_prefix=None,
+                  sort='price',
+                  descending=False,
+                  after=None,
+                  limit=None):
+  limit = limit or app.config['SEARCH_RESULT_LIMIT']
+  column, position, _ = PRODUCT_SORTS[sort]
+  conditions, params = [], []
+  if section_id is not None:
+    conditions.append('section_id = ?')
+    params.append(section_id)
+  if min_price is not None:
+    conditions.append('price >= ?')
+    params.append(min_price)
+  if max_price is not None:
+    conditions.append('price <= ?')
+    params.append(max_price)
+  if name_prefix:
+    conditions.append("name LIKE ? ESCAPE '\\'")
+    params.append(escape_like(name_prefix) + '%')
+  if after is not None:
+    # the plain bound lets sqlite seek the index, the row value is exact
+    operator = '<' if descending else '>'
+    conditions.append(f'{column} {operator}= ? AND ({column}, id) {operator} (?, ?)')
+    params.extend([after[0], after[0], after[1]])
+  where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+  direction = 'DESC' if descending else 'ASC'
+
+  # the page is read straight from products, a catalog cache reload after
+  # every admin write would cost more than the page itself
+  cursor = get_db().cursor()
+  cursor.execute(
+    f'''SELECT {PRODUCT_COLUMNS} FROM products {where}
+        ORDER BY {column} {direction}, id {direction}
+        LIMIT ?''', params + [limit + 1])
+  products = cursor.fetchall()
+
+  next_cursor = None
+  if len(products) > limit:
+    products = products[:limit]
+    next_cursor = f'{products[-1][position]}:{products[-1][0]}'
+  return products, next_cursor
+
+
+# price range filters of the search page, as query string arguments
+def price_search_filters(args):
+  filters = {
+    'min_price': float_arg(args, 'min_price'),
+    'max_price': float_arg(args, 'max_price'),
+    'section_id': int_arg(args, 'section_id'),
+    'sort': args.get('sort') if args.get('sort') == 'price_desc' else None
+  }
+  return {name: value for name, value in filters.items() if value is not None}
+
+
+def find_products_by_filters(filters, after=None):
+  return find_products(min_price=filters.get('min_price'),
+                       max_price=filters.get('max_price'),
+                       section_id=filters.get('section_id'),
+                       descending=filters.get('sort') == 'price_desc',
+                       after=after)
+
+
+# the section filter of the search page. price searches read their results
+# straight from products, so they should not pay for a catalog reload
+def fetch_section_names():
+  return get_db().execute(
+    "SELECT id, name FROM sections ORDER BY id").fetchall()
+
+
 # route for search page
 @app.route('/user/search', methods=['GET', 'POST'])
 def search():
@@ -690,80 +2734,101 @@ def search():
     user_id = session['user_id']
 
     if request.method == 'POST':
+      catalog = get_catalog()
       search_query = request.form.get('search_query')
-      section_results = []
-      cursor = get_db().cursor()
-
-      # Search by category name
-      cursor.execute("SELECT * FROM sections WHERE name LIKE ?",
-                     ('%' + search_query + '%', ))
-      sections = cursor.fetchall()
-
-      for section in sections:
-        section_id, section_name, section_image = section
-        cursor.execute("SELECT * FROM products WHERE section_id = ?",
-                       (section_id, ))
-        products_in_section = cursor.fetchall()
-        if products_in_section:
-          section_results.append((section_name, products_in_section))
+      limit = app.config['SEARCH_RESULT_LIMIT']
+      products_by_id = catalog['products_by_id']
+
+      # Search by category name, grouping matches by section in rank order
+      section_products = {}
+      section_names = {section[0]: section[1] for section in catalog['sections']}
+      for product_id in search_product_ids(search_query, ['section_name'],
+                                           limit):
+        product = products_by_id.get(product_id)
+        if product:
+          section_products.setdefault(product[7], []).append(product)
+      section_results = [(section_names[section_id], products)
+                         for section_id, products in section_products.items()]
 
       # Search by product name or price
       product_results = []
+      next_cursor = None
+      price_filters = {}
       try:
-        min_price = float(search_query)
-        cursor.execute("SELECT * FROM products WHERE price >= ?",
-                       (min_price, ))
-        product_results = cursor.fetchall()
+        price_filters = {'min_price': float(search_query)}
+        product_results, next_cursor = find_products_by_filters(price_filters)
       except ValueError:
-        cursor.execute("SELECT * FROM products WHERE name LIKE ?",
-                       ('%' + search_query + '%', ))
-        product_results = cursor.fetchall()
+        product_results = [
+          products_by_id[product_id]
+          for product_id in search_product_ids(search_query, ['name', 'unit'],
+                                               limit)
+          if product_id in products_by_id
+        ]
 
-      user_cartt = cursor.execute("SELECT * FROM user_cart WHERE user_id=?",
-                                  (user_id, )).fetchall()
       return render_template('search.html',
+                             sections=catalog['sections'],
                              section_results=section_results,
                              product_results=product_results,
-                             get_cart_quantity=get_cart_quantity,
-                             user_cartt=user_cartt,
+                             price_filters=price_filters,
+                             next_cursor=next_cursor,
+                             cart_quantities=fetch_cart_quantities(user_id),
                              search_query=search_query)
 
+    # Search by price range, section and sort order, one page at a time
+    price_filters = price_search_filters(request.args)
+    if price_filters:
+      product_results, next_cursor = find_products_by_filters(
+        price_filters,
+        after=parse_product_cursor(request.args.get('after'), 'price'))
+      return render_template('search.html',
+                             sections=fetch_section_names(),
+                             section_results=[],
+                             product_results=product_results,
+                             price_filters=price_filters,
+                             next_cursor=next_cursor,
+                             cart_quantities=fetch_cart_quantities(user_id))
+
     return render_template('search.html',
+                           sections=fetch_section_names(),
                            section_results=[],
-                           product_results=[])
+                           product_results=[],
+                           price_filters={})
 
   return redirect(url_for('login'))
 
 
-# User cart
-@app.route('/user/cart', methods=['GET'])
-def user_cart():
-  if 'user_id' in session:
-    user_id = session['user_id']
-    cursor = get_db().cursor()
+# rendering the cart page, with the lines a failed checkout could not fulfil
+def render_user_cart(user_id, checkout_errors=()):
+  cursor = get_db().cursor()
 
-    # Retrieve cart items for the user from the database
-    cart = '''
-            SELECT products.*, user_cart.quantity
-            FROM products
-            JOIN user_cart ON products.id = user_cart.product_id
-            WHERE user_cart.user_id = ?
-        '''
-    user_cart = cursor.execute(cart, (user_id, )).fetchall()
+  # Retrieve cart items for the user from the database
+  cart = f'''
+          SELECT {PRODUCT_COLUMNS}, user_cart.quantity
+          FROM products
+          JOIN user_cart ON products.id = user_cart.product_id
+          WHERE user_cart.user_id = ?
+      '''
+  user_cart = cursor.execute(cart, (user_id, )).fetchall()
+
+  product_total = (item[4] * item[9] for item in user_cart)
+  # Calculate total price
+  cart_total = sum(item[4] * item[9] for item in user_cart)
 
-    product_total = (item[4] * item[9] for item in user_cart)
-    # Calculate total price
-    cart_total = sum(item[4] * item[9] for item in user_cart)
+  cart_quantities = {item[0]: item[9] for item in user_cart}
 
-    user_cartt = cursor.execute("SELECT * FROM user_cart WHERE user_id=?",
-                                (user_id, )).fetchall()
+  return render_template('cart.html',
+                         user_cart=user_cart,
+                         product_total=product_total,
+                         cart_total=cart_total,
+                         cart_quantities=cart_quantities,
+                         checkout_errors=checkout_errors)
 
-    return render_template('cart.html',
-                           user_cart=user_cart,
-                           product_total=product_total,
-                           cart_total=cart_total,
-                           get_cart_quantity=get_cart_quantity,
-                           user_cartt=user_cartt)
+
+# User cart
+@app.route('/user/cart', methods=['GET'])
+def user_cart():
+  if 'user_id' in session:
+    return render_user_cart(session['user_id'])
 
   return redirect(url_for('login'))
 
@@ -793,6 +2858,7 @@ def add_to_cart():
         "INSERT INTO user_cart (user_id, product_id, quantity) VALUES (?, ?, ?)",
         (user_id, product_id, quantity))
 
+    bump_cart_version(cursor, user_id)
     get_db().commit()
 
     return redirect(request.referrer or url_for('user_dashboard'))
@@ -811,6 +2877,7 @@ def remove_from_cart():
     # Remove the item from the user's cart in the database
     cursor.execute('DELETE FROM user_cart WHERE user_id=? AND product_id=?',
                    (user_id, product_id))
+    bump_cart_version(cursor, user_id)
     get_db().commit()
 
     return redirect(request.referrer or url_for('user_dashboard'))
@@ -818,45 +2885,57 @@ def remove_from_cart():
   return redirect(url_for('login'))
 
 
-# Functions needed during checkout
-
-
-def remove_cart_item(user_id, product_id):
-  cursor = get_db().cursor()
-  cursor.execute("DELETE FROM user_cart WHERE user_id=? AND product_id=?",
-                 (user_id, product_id))
-  get_db().commit()
-
-
-def update_product_available_quantity(product_id, new_available_quantity):
-  cursor = get_db().cursor()
-  cursor.execute("UPDATE products SET available_quantity=? WHERE id=?",
-                 (new_available_quantity, product_id))
-  get_db().commit()
-
-
-# Function for inserting shop gistory data after succesful checkout
-def create_shopping_history(user_id, user_cart):
-  cursor = get_db().cursor()
-  purchase_date = datetime.now().strftime('%m-%d-%Y %H:%M')
-
-  order_id = str(uuid.uuid4())
-  print(order_id)
-  for cart_item in user_cart:
-    product_id = cart_item[0]
-    quantity = cart_item[5]
+# placing an order in one write transaction. stock is only decremented where
+# enough is left at that moment, so concurrent checkouts can never oversell.
+# returns the order id, or None and the cart lines that could not be fulfilled
+def place_order(user_id):
+  db = get_db()
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    cursor = db.cursor()
+    user_cart = fetch_user_cart(user_id)
+    failed_lines = []
+    for product_id, name, price, unit, available_quantity, quantity in user_cart:
+      if quantity < 1:
+        failed_lines.append((name, quantity, available_quantity))
+        continue
+      cursor.execute(
+        '''UPDATE products SET available_quantity = available_quantity - ?
+           WHERE id = ? AND available_quantity >= ?''',
+        (quantity, product_id, quantity))
+      if cursor.rowcount == 0:
+        failed_lines.append((name, quantity, available_quantity))
+
+    if failed_lines or not user_cart:
+      db.rollback()
+      return None, failed_lines
+
+    order_id = str(uuid.uuid4())
+    purchase_date = datetime.now().strftime('%Y-%m-%d %H:%M')
     cursor.execute(
-      "INSERT INTO shopping_history (order_id, user_id, product_id, quantity, purchase_date) VALUES (?, ?, ?, ?, ?)",
-      (order_id, user_id, product_id, quantity, purchase_date))
-
-  get_db().commit()
-
-
-# for clearing user's cart
-def clear_user_cart(user_id):
-  cursor = get_db().cursor()
-  cursor.execute("DELETE FROM user_cart WHERE user_id=?", (user_id, ))
-  get_db().commit()
+      '''INSERT INTO orders (id, user_id, created_at, item_count, total)
+         VALUES (?, ?, ?, ?, ?)''',
+      (order_id, user_id, purchase_date, sum(item[5] for item in user_cart),
+       sum(item[5] * item[2] for item in user_cart)))
+    # lines keep the name, price and unit they were bought at
+    cursor.executemany(
+      '''INSERT INTO shopping_history
+         (order_id, user_id, product_id, quantity, purchase_date,
+          product_name, unit_price, unit)
+         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+      [(order_id, user_id, item[0], item[5], purchase_date, item[1], item[2],
+        item[3]) for item in user_cart])
+    record_sales(cursor, [(item[0], item[5], item[2]) for item in user_cart],
+                 purchase_date)
+    cursor.execute("DELETE FROM user_cart WHERE user_id=?", (user_id, ))
+    bump_cart_version(cursor, user_id)
+    bump_catalog_version(cursor,
+                         stock_product_ids=[item[0] for item in user_cart])
+    db.commit()
+    return order_id, []
+  except BaseException:
+    db.rollback()
+    raise
 
 
 # route for checkout button
@@ -864,27 +2943,11 @@ def clear_user_cart(user_id):
 def checkout():
   if 'user_id' in session:
     user_id = session['user_id']
-    user_cart = fetch_user_cart(user_id)  # Fetch user's cart items
-
-    for cart_item in user_cart:
-      product_id = cart_item[0]
-      requested_quantity = cart_item[5]
-      available_quantity = cart_item[4]
-
-      if requested_quantity > available_quantity:
-        remove_cart_item(user_id, product_id)  # Remove the product from cart
-        return redirect(url_for('user_cart'))
+    order_id, failed_lines = place_order(user_id)
 
-      if available_quantity == 0:
-        remove_cart_item(user_id, product_id)  # Remove the product from cart
-        return redirect(url_for('user_cart'))
-
-      new_available_quantity = available_quantity - requested_quantity
-      update_product_available_quantity(product_id, new_available_quantity)
-
-    create_shopping_history(user_id,
-                            user_cart)  # Create shopping history entry
-    clear_user_cart(user_id)  # Clear user's cart
+    if order_id is None:
+      # nothing was bought, show which lines need to change
+      return render_user_cart(user_id, checkout_errors=failed_lines)
 
     return redirect(url_for('thanks'))
 
@@ -900,22 +2963,51 @@ def thanks():
   return redirect(url_for('login'))
 
 
-# fetching purchase history
-def fetch_purchase_history(user_id):
+# keyset cursor "<created_at>|<order_id>" of the last order on a page
+def parse_history_cursor(value):
+  if not value or '|' not in value:
+    return None
+  return tuple(value.split('|', 1))
+
+
+# fetching one page of a user's orders, newest first, from the precomputed
+# orders table. returns [(order_id, created_at, total, items)] and the cursor
+# of the next page (None on the last one)
+def fetch_purchase_history(user_id, after=None, limit=None):
+  limit = limit or app.config['HISTORY_PAGE_SIZE']
   cursor = get_db().cursor()
-  history_query = '''
-        SELECT shopping_history.order_id,
-               shopping_history.purchase_date,
-               products.name,
-               shopping_history.quantity,
-               products.price, products.unit
-        FROM shopping_history
-        JOIN products ON shopping_history.product_id = products.id
-        WHERE shopping_history.user_id = ?
-    '''
-  user_history = cursor.execute(history_query, (user_id, )).fetchall()
+  conditions, params = ['user_id = ?'], [user_id]
+  if after is not None:
+    conditions.append('(created_at, id) < (?, ?)')
+    params.extend(after)
+  orders = cursor.execute(
+    f'''
+        SELECT id, created_at, total
+        FROM orders
+        WHERE {' AND '.join(conditions)}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+
+  next_cursor = None
+  if len(orders) > limit:
+    orders = orders[:limit]
+    next_cursor = f'{orders[-1][1]}|{orders[-1][0]}'
+
+  items_by_order = {order[0]: [] for order in orders}
+  if orders:
+    placeholders = ', '.join('?' * len(orders))
+    cursor.execute(
+      f'''
+          SELECT order_id, product_name, quantity, unit_price, unit
+          FROM shopping_history
+          WHERE order_id IN ({placeholders})
+      ''', list(items_by_order))
+    for row in cursor:
+      items_by_order[row[0]].append(row[1:])
 
-  return user_history
+  return [(order_id, created_at, total, items_by_order[order_id])
+          for order_id, created_at, total in orders], next_cursor
 
 
 # Route to show user's history
@@ -923,23 +3015,12 @@ def fetch_purchase_history(user_id):
 def purchase_history():
   if 'user_id' in session:
     user_id = session['user_id']
-    user_history = fetch_purchase_history(user_id)
-
-    # Organize user_history by order_id
-    order_history = {}
-    for row in user_history:
-      order_id = row[0]
-      if order_id not in order_history:
-        order_history[order_id] = []
-      order_history[order_id].append(row)
-
-    # Calculate order_total for each order
-    for order_id, items in order_history.items():
-      order_total = sum(item[3] * item[4] for item in items)
-      order_history[order_id] = (order_history[order_id], order_total)
+    orders, next_cursor = fetch_purchase_history(
+      user_id, after=parse_history_cursor(request.args.get('after')))
 
     return render_template('purchase_history.html',
-                           order_history=order_history)
+                           orders=orders,
+                           next_cursor=next_cursor)
 
   return redirect(url_for('login'))
 
@@ -950,6 +3031,327 @@ def user_logout():
   return redirect(url_for('login'))
 
 
+# request metrics. timing starts with the request_started signal, before any
+# before_request hook runs
+@request_started.connect_via(app)
+def start_request_metrics(sender, **extra):
+  if app.config['METRICS']:
+    g._metrics_started = time.perf_counter()
+    _request_stats.current = {'statements': 0, 'sql_seconds': 0.0}
+
+
+@app.after_request
+def record_request_metrics(response):
+  started = g.pop('_metrics_started', None)
+  if started is None:
+    return response
+  stats = _request_stats.current
+  _request_stats.current = None
+  endpoint = request.endpoint or 'unknown'
+  with metrics_lock:
+    request_latency.observe((endpoint, request.method),
+                            time.perf_counter() - started)
+    request_count.inc((endpoint, request.method, str(response.status_code)))
+    request_statements.observe((endpoint, ), stats.get('statements', 0))
+    request_sql_time.observe((endpoint, ), stats.get('sql_seconds', 0.0))
+  return response
+
+
+@before_render_template.connect_via(app)
+def start_template_metrics(sender, template, context, **extra):
+  if app.config['METRICS']:
+    g.setdefault('_template_started', []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def record_template_metrics(sender, template, context, **extra):
+  started = g.get('_template_started')
+  if started:
+    elapsed = time.perf_counter() - started.pop()
+    with metrics_lock:
+      template_render_time.observe((template.name or 'string', ), elapsed)
+
+
+# prometheus text format metrics, for admins or a scraper sending the
+# configured bearer token
+@app.route('/admin/metrics')
+def admin_metrics():
+  if not app.config['METRICS']:
+    return "Metrics are disabled.", 404
+  token = app.config['METRICS_TOKEN']
+  authorized = 'admin_id' in session or (
+    token and request.headers.get('Authorization') == f'Bearer {token}')
+  if not authorized:
+    return redirect(url_for('admin_login'))
+
+  with metrics_lock:
+    lines = [line for metric in METRICS for line in metric.render()]
+  return Response('\n'.join(lines) + '\n',
+                  mimetype='text/plain; version=0.0.4')
+
+
+# slowest statements since startup (or the last reset), by total time
+@app.route('/admin/slow_queries')
+def admin_slow_queries():
+  if 'admin_id' in session:
+    with slow_queries_lock:
+      entries = sorted((dict(entry) for entry in slow_queries.values()),
+                       key=lambda entry: entry['total'],
+                       reverse=True)
+    return render_template('admin_slow_queries.html',
+                           entries=entries,
+                           threshold=app.config['SLOW_QUERY_MS'])
+
+  return redirect(url_for('admin_login'))
+
+
+@app.route('/admin/slow_queries/reset', methods=['POST'])
+def reset_slow_queries():
+  if 'admin_id' in session:
+    with slow_queries_lock:
+      slow_queries.clear()
+    return redirect(url_for('admin_slow_queries'))
+
+  return redirect(url_for('admin_login'))
+
+
+# background job status for admins
+@app.route('/admin/jobs')
+def admin_jobs():
+  if 'admin_id' in session:
+    cursor = get_db().cursor()
+    status_counts = cursor.execute(
+      "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+    jobs = cursor.execute(
+      '''SELECT id, kind, status, attempts, last_error, created_at, updated_at
+         FROM jobs ORDER BY id DESC LIMIT 100''').fetchall()
+    return render_template('admin_jobs.html',
+                           status_counts=status_counts,
+                           jobs=jobs)
+
+  return redirect(url_for('admin_login'))
+
+
+# re-queueing a failed job
+@app.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+  if 'admin_id' in session:
+    get_db().execute(
+      '''UPDATE jobs SET status = 'pending', attempts = 0, run_after = ?
+         WHERE id = ? AND status = 'failed' ''', (time.time(), job_id))
+    get_db().commit()
+    return redirect(url_for('admin_jobs'))
+
+  return redirect(url_for('admin_login'))
+
+
+# json api. responses carry an ETag built from the catalog (and cart)
+# versions, so polling clients get a 304 without the payload being rebuilt
+API_PAGE_SIZE_LIMIT = 200
+
+
+def api_error(message, status):
+  return jsonify(error=message), status
+
+
+# a 304 when the client already has this version, else the built payload
+def conditional_json(etag, build_payload, private=False):
+  if request.if_none_match.contains_weak(etag):
+    response = make_response('', 304)
+  else:
+    response = jsonify(build_payload())
+  response.set_etag(etag)
+  response.cache_control.no_cache = True
+  if private:
+    response.cache_control.private = True
+  else:
+    response.cache_control.public = True
+  return response
+
+
+def product_payload(product):
+  return {
+    'id': product[0],
+    'name': product[1],
+    'price': product[4],
+    'unit': product[5],
+    'available_quantity': product[6],
+    'section_id': product[7],
+    'expiry_date': product[3],
+    'image': image_url(product[8], 'card') if product[8] else None
+  }
+
+
+# the etags come from the version row alone, so a 304 never loads the catalog
+@app.route('/api/v1/sections')
+def api_sections():
+  version, _ = fetch_catalog_version()
+
+  def build_payload():
+    db = get_db()
+    product_counts = dict(
+      db.execute(
+        "SELECT section_id, COUNT(*) FROM products GROUP BY section_id"))
+    return {
+      'sections': [{
+        'id': section[0],
+        'name': section[1],
+        'image': image_url(section[2], 'card') if section[2] else None,
+        'product_count': product_counts.get(section[0], 0)
+      } for section in db.execute(
+        "SELECT id, name, image FROM sections ORDER BY id")]
+    }
+
+  return conditional_json(f"sections-{version}", build_payload)
+
+
+# products filtered like the admin listing, one keyset page at a time
+@app.route('/api/v1/products')
+def api_products():
+  version, stock_version = fetch_catalog_version()
+  sort = request.args.get('sort', 'price')
+  if sort not in PRODUCT_SORTS:
+    return api_error(f"sort must be one of {', '.join(PRODUCT_SORTS)}", 400)
+  limit = min(int_arg(request.args, 'limit') or app.config['SEARCH_RESULT_LIMIT'],
+              API_PAGE_SIZE_LIMIT)
+
+  def build_payload():
+    products, next_cursor = find_products(
+      min_price=float_arg(request.args, 'min_price'),
+      max_price=float_arg(request.args, 'max_price'),
+      section_id=int_arg(request.args, 'section_id'),
+      name_prefix=request.args.get('q', '').strip() or None,
+      sort=sort,
+      descending=request.args.get('order') == 'desc',
+      after=parse_product_cursor(request.args.get('after'), sort),
+      limit=max(limit, 1))
+    return {
+      'products': [product_payload(product) for product in products],
+      'next': next_cursor
+    }
+
+  return conditional_json(f"products-{version}-{stock_version}",
+                          build_payload)
+
+
+def fetch_cart_version(user_id):
+  row = get_db().execute("SELECT cart_version FROM users WHERE id = ?",
+                         (user_id, )).fetchone()
+  return row[0] if row else 0
+
+
+def cart_payload(user_id):
+  items = [{
+    'product_id': product_id,
+    'name': name,
+    'price': price,
+    'unit': unit,
+    'available_quantity': available_quantity,
+    'quantity': quantity,
+    'line_total': price * quantity
+  } for product_id, name, price, unit, available_quantity, quantity in
+           fetch_user_cart(user_id)]
+  return {
+    'items': items,
+    'item_count': sum(item['quantity'] for item in items),
+    'total': sum(item['line_total'] for item in items)
+  }
+
+
+def cart_etag(user_id):
+  version, stock_version = fetch_catalog_version()
+  return f"cart-{user_id}-{fetch_cart_version(user_id)}-{version}-{stock_version}"
+
+
+# parsing [{"product_id": .., "quantity": ..}] into product_id -> quantity,
+# later entries for the same product win. raises ValueError
+def parse_cart_changes(payload):
+  items = payload.get('items') if isinstance(payload, dict) else None
+  if not isinstance(items, list) or not items:
+    raise ValueError('items must be a non-empty list')
+  changes = {}
+  for item in items:
+    if not isinstance(item, dict):
+      raise ValueError('items must be objects')
+    product_id, quantity = item.get('product_id'), item.get('quantity')
+    if type(product_id) is not int or type(quantity) is not int or quantity < 0:
+      raise ValueError('product_id and quantity must be integers, quantity >= 0')
+    changes[product_id] = quantity
+  return changes
+
+
+# applying a batch of cart quantity changes in one transaction. stock of all
+# products is checked with a single query and nothing is written if any line
+# fails. quantity 0 removes the line. returns the list of failed lines
+def update_cart(user_id, changes):
+  db = get_db()
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    cursor = db.cursor()
+    stock = dict(cursor.execute(
+      '''SELECT id, available_quantity FROM products
+         WHERE id IN (SELECT value FROM json_each(?))''',
+      (json.dumps(list(changes)), )))
+    errors = []
+    for product_id, quantity in changes.items():
+      if product_id not in stock:
+        errors.append({'product_id': product_id, 'error': 'unknown product'})
+      elif quantity > stock[product_id]:
+        errors.append({'product_id': product_id, 'error': 'not enough stock',
+                       'available_quantity': stock[product_id]})
+    if errors:
+      db.rollback()
+      return errors
+
+    cursor.executemany(
+      '''INSERT INTO user_cart (user_id, product_id, quantity) VALUES (?, ?, ?)
+         ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = excluded.quantity''',
+      [(user_id, product_id, quantity)
+       for product_id, quantity in changes.items() if quantity > 0])
+    cursor.executemany(
+      "DELETE FROM user_cart WHERE user_id = ? AND product_id = ?",
+      [(user_id, product_id)
+       for product_id, quantity in changes.items() if quantity == 0])
+    bump_cart_version(cursor, user_id)
+    db.commit()
+    return []
+  except BaseException:
+    db.rollback()
+    raise
+
+
+# the cart changes with the user's own writes and with product prices/stock.
+# POST sets the quantities of several products at once and answers with the
+# updated cart, replacing one form post and page render per product
+@app.route('/api/v1/cart', methods=['GET', 'POST'])
+def api_cart():
+  if 'user_id' not in session:
+    return api_error('login required', 401)
+  user_id = session['user_id']
+
+  if request.method == 'POST':
+    try:
+      changes = parse_cart_changes(request.get_json(silent=True))
+    except ValueError as error:
+      return api_error(str(error), 400)
+    errors = update_cart(user_id, changes)
+    if errors:
+      return jsonify(error='cart not updated', items=errors), 409
+    response = jsonify(cart_payload(user_id))
+    response.set_etag(cart_etag(user_id))
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response
+
+  return conditional_json(cart_etag(user_id), lambda: cart_payload(user_id),
+                          private=True)
+
+
+@app.template_filter('timestamp')
+def format_timestamp(value):
+  return datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+
+
 @app.route('/admin/logout')
 def admin_logout():
   if 'admin_id' in session:
@@ -0,0 +1,37 @@
+// submits the product card "Add" forms to the batch cart api, so changing a
+// quantity does not reload the whole page. falls back to the plain form post
+document.addEventListener('submit', function (event) {
+  var form = event.target;
+  if (!form.matches('form[data-cart-api]')) {
+    return;
+  }
+  event.preventDefault();
+  var button = form.querySelector('button');
+  var productId = parseInt(form.elements.product_id.value, 10);
+  var quantity = parseInt(form.elements.quantity.value, 10);
+  button.disabled = true;
+
+  fetch(form.dataset.cartApi, {
+    method: 'POST',
+    credentials: 'same-origin',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({items: [{product_id: productId, quantity: quantity}]})
+  }).then(function (response) {
+    if (response.status === 409) {
+      return response.json().then(function (body) {
+        var item = body.items[0];
+        alert(item.available_quantity !== undefined
+          ? 'Only ' + item.available_quantity + ' left in stock.'
+          : 'This product is no longer available.');
+        button.disabled = false;
+      });
+    }
+    if (!response.ok) {
+      throw new Error(response.statusText);
+    }
+    button.textContent = 'Added';
+    button.disabled = false;
+  }).catch(function () {
+    form.submit();
+  });
+});